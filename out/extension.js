@@ -44,10 +44,10 @@ function activate(context) {
     }
     const clientOptions = {
         documentSelector: [{ scheme: "file", language: "zoof" }],
-        // synchronize: {
-        //     // Notify the server about file changes to '.clientrc files contained in the workspace
-        //     fileEvents: workspace.createFileSystemWatcher('**/.clientrc')
-        // }
+        synchronize: {
+            // Notify the server about changes to source files, to keep its index current
+            fileEvents: vscode_1.workspace.createFileSystemWatcher("**/*.zf"),
+        },
     };
     client = new node_1.LanguageClient("zoof", "Zoof", serverOptions, clientOptions);
     client.start();
@@ -1,3 +1,19 @@
-from .server import __version__, LanguageServer, register_method
-from .utils import logger
-from . import methods
+# The server is imported when it is first used, so that light submodules
+# (like .startup, or the modules used in the worker processes) can be
+# imported without loading everything.
+
+_lazy_names = {
+    "__version__": "server",
+    "LanguageServer": "server",
+    "register_method": "server",
+    "logger": "utils",
+}
+
+
+def __getattr__(name):
+    module_name = _lazy_names.get(name, None)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+
+    return getattr(import_module("." + module_name, __name__), name)
@@ -1,16 +1,72 @@
-import sys
 import time
 
+t0 = time.perf_counter()
+
+import sys
+import argparse
+
 sys.path.append(".")  # os.path.dirname(os.path.dirname(__file__)))
 
-from pyserver import LanguageServer, logger
+from pyserver.startup import StartupTimer, ImportTimer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Language server for Zoof.")
+    parser.add_argument("--tcp", help="Start a TCP server", action="store_true")
+    parser.add_argument(
+        "--stdio", help="Start a STDIO server (default)", action="store_true"
+    )
+    parser.add_argument(
+        "--daemon",
+        help="Start a TCP server that serves multiple clients",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=600.0,
+        help="Seconds without clients after which the daemon stops (0 is never)",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8339)
+    parser.add_argument(
+        "--startup-report",
+        help="Measure the imports, and print a startup report to stderr",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    startup = StartupTimer(t0)
+    if args.startup_report:
+        startup.import_timer = ImportTimer().install()
+
+    from pyserver import LanguageServer, logger
+
+    if args.daemon:
+        from pyserver.daemon import Daemon
+
+        startup.mark("imports done")
+        logger.warning("\n" + "=" * 80)
+        logger.warning("Starting daemon at " + time.strftime("%Y-%m-%d %H:%M:%S"))
+        daemon = Daemon(startup, args.startup_report, args.idle_timeout)
+        daemon.start(args.host, args.port)
+        logger.warning("Stopping daemon")
+        return
+
+    startup.mark("imports done")
+    server = LanguageServer(startup, report_startup=args.startup_report)
 
+    logger.warning("\n" + "=" * 80)
+    logger.warning("Starting server at " + time.strftime("%Y-%m-%d %H:%M:%S"))
 
-server = LanguageServer()
+    if args.tcp:
+        server.start("tcp", args.host, args.port)
+    else:
+        server.start("stdio")
 
-logger.warning("\n" + "=" * 80)
-logger.warning("Starting server at " + time.strftime("%Y-%m-%d %H:%M:%S"))
+    logger.warning("Stopping server")
 
-server.start()
 
-logger.warning("Stopping server")
+# Guard, because worker processes (spawned) import the main module
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+Analysis of documents, in worker processes.
+
+Analysing a document is cpu-bound work, so it runs in a process pool, to
+keep the event loop free for interactive requests. Changes are debounced
+per document, and only the latest version of a document is analysed: when
+a document changes, a pending analysis for the previous version that is
+still waiting for the delay is cancelled. An analysis that is already
+running in a worker is not: cancelling it would not stop the worker, and
+on a big file that is typed in, no analysis would ever finish. Instead,
+the next analysis waits for it, and it catches up with the changes.
+
+Small edits are applied to the previous result incrementally, in the
+server process itself, because that is cheaper than sending the document
+to a worker. A result that comes back from a worker for an outdated
+version is brought up to date in the same way.
+
+The scopes are shifted along with such edits, which keeps the line numbers
+correct, but not the structure of the edited lines. They are rebuilt by
+the next regular (debounced) analysis. An urgent analysis, for a request
+that needs the result right away, only shifts them, and schedules a
+regular analysis to rebuild them.
+
+The worker pool keeps the results of full analyses by content, pickled, so
+that a document that is opened again (possibly by another session of the
+daemon) does not have to be analysed again. Each user of a cached result
+gets its own copy, because results are updated in-place.
+"""
+
+import os
+import time
+import pickle
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor
+
+from .utils import logger
+from .lexer import tokenize_line, TokenStream
+from .scopes import build_scopes
+
+
+DEFAULT_DELAY = 0.3  # seconds to wait for more changes
+DEFAULT_WORKERS = max(1, min(2, (os.cpu_count() or 1) - 1))
+
+# Edits that touch more lines than this are analysed from scratch in a worker
+MAX_INCREMENTAL_LINES = 1000
+
+# The max total size of the pickled results in the cache
+RESULT_CACHE_SIZE = 64 * 2**20
+
+
+# == Running in worker processes
+
+
+def _init_worker():
+    """Runs once in each worker, so it is warm when the first job comes in."""
+    tokenize_line("func warm_up() 'x' # compile the regexes")
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def analyze(text):
+    """Analyse the given source. Returns (TokenStream, ScopeIndex)."""
+    lines = text.split("\n")
+    if "\r" in text:
+        # Without line endings, like Document.get_line(), which incremental
+        # updates use, so that both give the same tokens
+        lines = [line.rstrip("\r") for line in lines]
+    tokens = TokenStream.from_lines(lines)
+    scopes = build_scopes(lines.__getitem__, tokens)
+    return tokens, scopes
+
+
+def analyze_pickled(text):
+    """Analyse the given source. Returns the pickled (TokenStream, ScopeIndex)."""
+    return pickle.dumps(analyze(text), pickle.HIGHEST_PROTOCOL)
+
+
+# == Running in the server
+
+
+def hash_text(text):
+    import hashlib
+
+    return hashlib.blake2b(text.encode(errors="surrogatepass"), digest_size=16).digest()
+
+
+class Analysis:
+    """The result of analysing a specific version of a document."""
+
+    __slots__ = [
+        "uri",
+        "version",
+        "tokens",
+        "scopes",
+        "settled",
+        "references",
+        "outline",
+    ]
+
+    def __init__(self, uri, version, tokens, scopes, settled=True):
+        self.uri = uri
+        self.version = version
+        self.tokens = tokens  # TokenStream
+        self.scopes = scopes  # ScopeIndex
+        self.settled = settled  # False if the scopes were only shifted
+        self.references = None  # ReferenceIndex, built when first needed
+        self.outline = None  # Outline, built when first needed
+
+    def __repr__(self):
+        return f"<Analysis {self.uri} v{self.version}>"
+
+
+class WorkerPool:
+    """The worker processes, and a cache of analysis results by content.
+
+    In daemon mode, one pool is shared by all sessions.
+    """
+
+    def __init__(self):
+        self.workers = DEFAULT_WORKERS
+        self._executor = None
+        self._ready = []  # futures of the warm-up jobs
+        self._results = OrderedDict()  # hash of text -> pickled result
+        self._results_size = 0
+
+    def configure(self, options):
+        """Apply initialization options. Only has effect before the start."""
+        options = options or {}
+        if self._executor is None:
+            self.workers = int(options.get("analysisWorkers", self.workers))
+
+    def start(self):
+        """Start the worker processes (if they are not already running)."""
+        if self._executor is not None or self.workers <= 0:
+            return
+        # Imported here, because multiprocessing takes a while to import
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+
+        logger.info(f"Starting {self.workers} analysis workers")
+        self._executor = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        # Spawn the workers now, rather than when the first job comes in
+        self._ready = [self._executor.submit(_warm_up) for _ in range(self.workers)]
+
+    async def warm_up(self):
+        """Start the workers, and wait until they are ready."""
+        self.start()
+        ready, self._ready = self._ready, []
+        if ready:
+            try:
+                await asyncio.gather(*map(asyncio.wrap_future, ready))
+            except BrokenExecutor:
+                logger.error("Analysis worker died while starting")
+
+    def shutdown(self):
+        self._results.clear()
+        self._results_size = 0
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func, *args):
+        """Run a function in a worker process, and return its result."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        except BrokenExecutor:
+            logger.error("Analysis worker died, restarting the pool")
+            self._executor = None
+            raise
+
+    async def analyze(self, text):
+        """Analyse the text in a worker, or get the result from the cache.
+        Returns a new (TokenStream, ScopeIndex).
+        """
+        key = hash_text(text)
+        data = self._results.get(key, None)
+        if data is None:
+            data = await self.run(analyze_pickled, text)
+            self._results[key] = data
+            self._results_size += len(data)
+            while self._results_size > RESULT_CACHE_SIZE and len(self._results) > 1:
+                _, old = self._results.popitem(last=False)
+                self._results_size -= len(old)
+        else:
+            self._results.move_to_end(key)
+        return pickle.loads(data)
+
+
+class Analyzer:
+    """Schedules the analysis of documents, and keeps the results."""
+
+    def __init__(self, server, pool=None):
+        self._server = server
+        self.delay = DEFAULT_DELAY
+        self.pool = pool or WorkerPool()
+        self._owns_pool = pool is None
+        # uri -> (version, task, time when the delay ends, task it waits for)
+        self._tasks = {}
+        self._results = {}  # uri -> Analysis
+        self.full = 0  # number of analyses in a worker
+        self.incremental = 0  # number of incremental updates of a result
+        self.caught_up = 0  # number of worker results updated to a newer version
+
+    def configure(self, options):
+        """Apply initialization options."""
+        options = options or {}
+        self.delay = float(options.get("analysisDelay", self.delay))
+        self.pool.configure(options)
+
+    async def warm_up(self):
+        await self.pool.warm_up()
+
+    def shutdown(self):
+        """Cancel pending analyses, and stop the workers if they are ours."""
+        for _, task, _, _ in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._results.clear()
+        if self._owns_pool:
+            self.pool.shutdown()
+
+    def get_stats(self):
+        return {
+            "full": self.full,
+            "incremental": self.incremental,
+            "caught_up": self.caught_up,
+        }
+
+    def get_result(self, uri):
+        """Get the most recent Analysis of the document, or None."""
+        return self._results.get(uri, None)
+
+    def schedule(self, uri, delay=None, urgent=False):
+        """Schedule the analysis of the current version of a document. An
+        urgent analysis does not rebuild the scopes.
+        """
+        doc = self._server.documents.get(uri)
+        if doc is None:
+            return
+        loop = asyncio.get_running_loop()
+        wait_for = None
+        pending = self._tasks.pop(uri, None)
+        if pending is not None and not pending[1].done():
+            if pending[2] > loop.time():
+                pending[1].cancel()  # still waiting for the delay
+                wait_for = pending[3]
+            else:
+                wait_for = pending[1]  # running, let it finish
+        delay = self.delay if delay is None else delay
+        task = loop.create_task(self._analyze(uri, delay, wait_for, urgent))
+        self._tasks[uri] = doc.version, task, loop.time() + delay, wait_for
+
+    def close(self, uri):
+        pending = self._tasks.pop(uri, None)
+        if pending is not None:
+            pending[1].cancel()
+        self._results.pop(uri, None)
+
+    async def analyze(self, uri, attempts=3):
+        """Get the analysis for the current version of the document.
+
+        Waits for a pending analysis, or starts one without delay. Returns
+        None if the document is not open or the analysis fails.
+        """
+        for _ in range(attempts):
+            doc = self._server.documents.get(uri)
+            if doc is None:
+                return None
+            result = self._results.get(uri, None)
+            if result is not None and result.version == doc.version:
+                return result
+            pending = self._tasks.get(uri, None)
+            if (
+                pending is None
+                or pending[0] != doc.version
+                or pending[1].done()
+                or pending[2] > asyncio.get_running_loop().time()  # debouncing
+            ):
+                self.schedule(uri, 0, urgent=True)
+                pending = self._tasks[uri]
+            # Don't let cancelling the waiter cancel the analysis
+            await asyncio.wait([pending[1]])
+        return None
+
+    async def _analyze(self, uri, delay, wait_for=None, urgent=False):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if wait_for is not None and not wait_for.done():
+            await asyncio.wait([wait_for])
+
+        # Analyse the latest version
+        doc = self._server.documents.get(uri)
+        if doc is None:
+            return
+        previous = self._results.get(uri, None)
+        if previous is not None and self._update(doc, previous):
+            self.incremental += 1
+            tokens, scopes, version = previous.tokens, previous.scopes, doc.version
+            settled = previous.settled and previous.version == version
+        else:
+            version, text = doc.version, doc.text
+            try:
+                tokens, scopes = await self.pool.analyze(text)
+            except BrokenExecutor:
+                return
+            except Exception as err:
+                logger.error(f"Analysis of {uri} failed: {str(err)}")
+                return
+            self.full += 1
+
+            # Catch up with changes made in the mean time
+            doc = self._server.documents.get(uri)
+            if doc is None:
+                return
+            elif doc.version != version:
+                if not self._update(doc, Analysis(uri, version, tokens, scopes)):
+                    return  # outdated
+                self.caught_up += 1
+            settled = doc.version == version
+            version = doc.version
+
+        if not settled and not urgent:
+            # Get the structure of the edited lines right
+            scopes = build_scopes(doc.get_line, tokens)
+            settled = True
+
+        doc.drop_edits(version)
+        self._results[uri] = Analysis(uri, version, tokens, scopes, settled)
+        self._server.diagnostics.update(uri)
+        if self._tasks.get(uri, (None, None))[1] is asyncio.current_task():
+            self._tasks.pop(uri)
+        if not settled:
+            self.schedule(uri)  # rebuild the scopes when the document settles
+
+    def _update(self, doc, analysis):
+        """Try to update the analysis to the current version of the document.
+
+        Returns True on success.
+        """
+        edits = doc.get_edits(analysis.version)
+        if edits is None:
+            return False
+        if sum(added for _, _, added in edits) > MAX_INCREMENTAL_LINES:
+            return False
+        t0 = time.perf_counter()
+        count = analysis.tokens.update(doc.get_line, doc.line_count, edits)
+        for edit in edits:
+            analysis.scopes.apply_edit(*edit)
+        t1 = time.perf_counter()
+        logger.debug("Relexed %d lines in %0.2f ms", count, 1000 * (t1 - t0))
+        return True
@@ -0,0 +1,610 @@
+"""
+Record and replay LSP sessions, to benchmark the server.
+
+A trace is a JSON-lines file, with one message per line:
+{"t": seconds since the start, "dir": "in" or "out", "msg": {...}}.
+Messages with dir "in" go from the client to the server.
+
+Usage:
+
+    # Record a real session: configure the editor to run this as the server
+    python -m pyserver.benchmark record session.jsonl -- python -m pyserver
+
+    # Generate a synthetic session: open a big file, and type in bursts
+    python -m pyserver.benchmark generate typing.jsonl --lines 10000
+
+    # Replay a session against the server, and report
+    python -m pyserver.benchmark replay typing.jsonl --speed 2
+
+    # Generate and replay in one go
+    python -m pyserver.benchmark run --lines 10000 --bursts 20
+
+    # Replay as fast as possible, sending up to 100 messages per JSON-RPC batch
+    python -m pyserver.benchmark replay typing.jsonl --speed 0 --batch 100
+
+    # Measure the memory per open document, for a workspace of 100 files
+    python -m pyserver.benchmark memory --files 100 --lines 500
+
+The report has the latency per method (p50, p95, p99), the throughput, and
+the peak RSS and cpu time of the server process and its workers. The memory
+benchmark runs in-process, and reports the bytes per open document and per
+token.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+
+from .stats import Histogram
+from .framing import FrameParser, make_header
+
+
+SERVER_COMMAND = [sys.executable, "-m", "pyserver"]
+SERVER_CWD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# == Traces
+
+
+def read_trace(filename):
+    """Read a trace, returns a list of (t, dir, msg)."""
+    trace = []
+    with open(filename, "rb") as f:
+        for line in f:
+            if line.strip():
+                d = json.loads(line)
+                trace.append((d["t"], d["dir"], d["msg"]))
+    return trace
+
+
+def write_trace(filename, trace):
+    with open(filename, "wb") as f:
+        for t, direction, msg in trace:
+            d = {"t": round(t, 6), "dir": direction, "msg": msg}
+            f.write(json.dumps(d).encode() + b"\n")
+
+
+def encode_message(msg):
+    payload = json.dumps(msg).encode()
+    return make_header(len(payload)) + payload
+
+
+class _TraceWriter:
+    """Writes messages to a trace file, from multiple threads."""
+
+    def __init__(self, filename):
+        self._file = open(filename, "wb")
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+
+    def write(self, direction, payload):
+        t = time.perf_counter() - self._t0
+        try:
+            msg = json.loads(payload)
+        except Exception:
+            return
+        line = json.dumps({"t": round(t, 6), "dir": direction, "msg": msg})
+        with self._lock:
+            self._file.write(line.encode() + b"\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _pump(src, dst, direction, writer):
+    """Copy a framed stream from src to dst, and record the messages."""
+    parser = FrameParser()
+    while True:
+        data = src.read1(2**16) if hasattr(src, "read1") else src.read(2**16)
+        if not data:
+            break
+        dst.write(data)
+        dst.flush()
+        for payload in parser.feed(data):
+            writer.write(direction, payload)
+
+
+def record(filename, command):
+    """Run the server command as a proxy between the client (on stdio) and
+    the server, and record the messages in both directions.
+    """
+    writer = _TraceWriter(filename)
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    t = threading.Thread(target=_pump, args=(p.stdout, stdout, "out", writer))
+    t.daemon = True
+    t.start()
+    try:
+        _pump(stdin, p.stdin, "in", writer)
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
+        try:
+            p.stdin.close()
+        except OSError:
+            pass
+        p.wait()
+        t.join(1)
+        writer.close()
+    return p.returncode
+
+
+# == Synthetic sessions
+
+
+def make_source(line_count, seed=0):
+    """Generate Zoof source code with the given number of lines."""
+    r = random.Random(seed)
+    lines = []
+    i = 0
+    while len(lines) < line_count:
+        lines.extend(
+            [
+                f"struct Point{i}",
+                "    x int  # the x coordinate",
+                "    y int",
+                "",
+                f"func compute{i}(a, b)",
+                f"    total = a * {r.randint(0, 999)}",
+                "    if a > b and not false",
+                f"        return total + 'hello {i}'",
+                "    elif a == b",
+                "        return 'größer ✓'",
+                "    for j in range(b)",
+                f"        total = total + compute{max(0, i - 1)}(j, a)",
+                "    return total",
+                "",
+            ]
+        )
+        i += 1
+    return "\n".join(lines[:line_count]) + "\n"
+
+
+def make_session(
+    line_count=10000,
+    bursts=20,
+    burst_length=12,
+    interval=0.03,
+    pause=0.5,
+    seed=0,
+):
+    """Generate a trace of a typing session in a big document.
+
+    The document is opened, and then the user types in bursts of
+    burst_length characters, interval seconds apart, with a pause between
+    bursts. Like an editor, each keystroke is followed by a completion
+    request, and each burst by a semantic-tokens delta request.
+    """
+    r = random.Random(seed)
+    uri = "file:///benchmark/typing.zf"
+    text = make_source(line_count, seed)
+    line_lengths = [len(line) for line in text.split("\n")]
+
+    trace = []
+    t = 0.0
+    id = 0
+
+    def add(method, params, request=True):
+        nonlocal id
+        msg = {"jsonrpc": "2.0", "method": method, "params": params}
+        if request:
+            id += 1
+            msg["id"] = id
+        trace.append((t, "in", msg))
+
+    add(
+        "initialize",
+        {
+            "processId": None,
+            "clientInfo": {"name": "benchmark"},
+            "capabilities": {},
+            "workspaceFolders": [],
+        },
+    )
+    add("initialized", {}, False)
+    document = {"uri": uri, "languageId": "zoof", "version": 1, "text": text}
+    add("textDocument/didOpen", {"textDocument": document}, False)
+    add("textDocument/semanticTokens/full", {"textDocument": {"uri": uri}})
+    version = 1
+
+    for _ in range(bursts):
+        t += pause
+        line = r.randrange(len(line_lengths) - 1)
+        column = line_lengths[line]
+        word = "".join(r.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8))
+        typed = (" " + word * 2)[:burst_length]
+        for c in typed:
+            t += interval
+            version += 1
+            position = {"line": line, "character": column}
+            change = {"range": {"start": position, "end": position}, "text": c}
+            versioned = {"uri": uri, "version": version}
+            params = {"textDocument": versioned, "contentChanges": [change]}
+            add("textDocument/didChange", params, False)
+            column += 1
+            position = {"line": line, "character": column}
+            params = {"textDocument": {"uri": uri}, "position": position}
+            add("textDocument/completion", params)
+        # The result id is not known up front, so the server sends full data
+        params = {"textDocument": {"uri": uri}, "previousResultId": ""}
+        add("textDocument/semanticTokens/full/delta", params)
+        line_lengths[line] = column
+
+    t += pause
+    add("shutdown", None)
+    add("exit", None, False)
+    return trace
+
+
+# == Replaying
+
+
+class ReplayResult:
+    """The measurements of a replay."""
+
+    def __init__(self):
+        self.latencies = {}  # method -> Histogram
+        self.errors = {}  # method -> count
+        self.unanswered = 0
+        self.wall_time = 0.0
+        self.cpu_user = None
+        self.cpu_system = None
+        self.peak_rss = None  # bytes, of the largest process
+
+    def summary(self):
+        total = sum(h.count for h in self.latencies.values())
+        methods = {}
+        for method, histogram in sorted(self.latencies.items()):
+            d = {"count": histogram.count, "errors": self.errors.get(method, 0)}
+            d.update({k: round(v, 3) for k, v in histogram.summary().items()})
+            methods[method] = d
+        return {
+            "methods": methods,
+            "responses": total,
+            "unanswered": self.unanswered,
+            "wall_time": round(self.wall_time, 3),
+            "throughput": round(total / self.wall_time, 1) if self.wall_time else 0,
+            "cpu_user": self.cpu_user,
+            "cpu_system": self.cpu_system,
+            "peak_rss_mb": self.peak_rss and round(self.peak_rss / 2**20, 1),
+        }
+
+    def report(self):
+        """Get a human readable report."""
+        s = self.summary()
+        lines = [
+            f"{'method':<42} {'count':>6} {'errors':>6} "
+            f"{'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)"
+        ]
+        for method, d in s["methods"].items():
+            lines.append(
+                f"{method:<42} {d['count']:>6} {d['errors']:>6} "
+                f"{d['p50']:>8.2f} {d['p95']:>8.2f} {d['p99']:>8.2f} {d['max']:>8.2f}"
+            )
+        lines.append("")
+        lines.append(f"responses:  {s['responses']} ({s['unanswered']} unanswered)")
+        lines.append(f"wall time:  {s['wall_time']:.3f} s")
+        lines.append(f"throughput: {s['throughput']} responses/s")
+        if s["cpu_user"] is not None:
+            cpu = f"{s['cpu_user']:.3f} s user, {s['cpu_system']:.3f} s system"
+            lines.append(f"cpu time:   {cpu}")
+            lines.append(f"peak rss:   {s['peak_rss_mb']} MB")
+        return "\n".join(lines)
+
+
+def _child_usage():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def replay(trace, command=None, speed=1.0, rate=None, timeout=30.0, batch=1):
+    """Replay the client messages of a trace against a server process.
+
+    The messages are sent at their recorded times divided by speed, or at a
+    fixed rate (messages per second), or as fast as possible if speed is 0.
+    With batch > 1, messages that are due at the same time are sent together
+    as JSON-RPC batches of up to that many messages. Returns a ReplayResult.
+    """
+    command = command or SERVER_COMMAND
+    # The exit notification is sent when all requests have been answered
+    messages = [
+        (t, msg)
+        for t, direction, msg in trace
+        if direction == "in" and msg.get("method", None) != "exit"
+    ]
+    result = ReplayResult()
+    pending = {}  # id -> (method, send time)
+    lock = threading.Lock()
+    all_sent = threading.Event()
+    all_answered = threading.Event()
+
+    usage0 = _child_usage()
+    p = subprocess.Popen(
+        command,
+        cwd=SERVER_CWD,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+    def read():
+        parser = FrameParser()
+        while True:
+            data = p.stdout.read1(2**16)
+            if not data:
+                break
+            t = time.perf_counter()
+            for payload in parser.feed(data):
+                msgs = json.loads(payload)
+                for msg in msgs if isinstance(msgs, list) else [msgs]:
+                    if "method" in msg or "id" not in msg:
+                        continue  # a notification or request from the server
+                    with lock:
+                        method, sent = pending.pop(msg["id"], (None, None))
+                        done = all_sent.is_set() and not pending
+                    if method is not None:
+                        histogram = result.latencies.setdefault(method, Histogram())
+                        histogram.add(t - sent)
+                        if "error" in msg:
+                            result.errors[method] = result.errors.get(method, 0) + 1
+                    if done:
+                        all_answered.set()
+        all_answered.set()
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    def get_target(i, t):
+        if rate:
+            return i / rate
+        elif speed:
+            return t / speed
+        return 0
+
+    t0 = time.perf_counter()
+    try:
+        i = 0
+        while i < len(messages):
+            delay = t0 + get_target(i, messages[i][0]) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # Take the messages that are due, up to the batch size
+            now = time.perf_counter() - t0
+            group = [messages[i][1]]
+            i += 1
+            while (
+                i < len(messages)
+                and len(group) < batch
+                and get_target(i, messages[i][0]) <= now
+            ):
+                group.append(messages[i][1])
+                i += 1
+            with lock:
+                for msg in group:
+                    if "id" in msg and "method" in msg:
+                        pending[msg["id"]] = msg["method"], time.perf_counter()
+            p.stdin.write(encode_message(group[0] if len(group) == 1 else group))
+            p.stdin.flush()
+    except (BrokenPipeError, OSError):
+        pass
+    with lock:
+        all_sent.set()
+        if not pending:
+            all_answered.set()
+    all_answered.wait(timeout)
+    result.wall_time = time.perf_counter() - t0
+
+    # Stop the server
+    try:
+        p.stdin.write(encode_message({"jsonrpc": "2.0", "method": "exit"}))
+        p.stdin.close()
+    except (BrokenPipeError, OSError):
+        pass
+    try:
+        p.wait(timeout)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.wait()
+    reader.join(1)
+    result.unanswered = len(pending)
+
+    usage1 = _child_usage()
+    if usage0 is not None:
+        result.cpu_user = round(usage1.ru_utime - usage0.ru_utime, 3)
+        result.cpu_system = round(usage1.ru_stime - usage0.ru_stime, 3)
+        # ru_maxrss is in KiB on Linux, and in bytes on MacOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        result.peak_rss = usage1.ru_maxrss * scale
+    return result
+
+
+# == Memory
+
+
+def measure_memory(file_count=100, line_count=500, seed=0):
+    """Measure the memory that the server keeps for a workspace of generated
+    files that are all open: the documents, and the tokens, scopes and
+    references of their analysis. Returns a dict with the bytes per part.
+
+    The analysis is passed through pickle, like the results from the
+    workers, so that the objects are like the ones that the server holds.
+    """
+    import gc
+    import pickle
+    import tracemalloc
+    from .documents import DocumentStore
+    from .lexer import TokenStream
+    from .scopes import build_scopes
+    from .references import build_references
+
+    texts = [make_source(line_count, seed + i) for i in range(file_count)]
+    store = DocumentStore()
+    kept = {}
+    sizes = {}
+
+    def measure(name, func):
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        kept[name] = func()
+        gc.collect()
+        sizes[name] = tracemalloc.get_traced_memory()[0] - before
+
+    def via_pickle(ob):
+        return pickle.loads(pickle.dumps(ob))
+
+    tracemalloc.start()
+    try:
+        measure(
+            "documents",
+            lambda: [
+                store.open(f"file:///benchmark/file{i}.zf", 1, text)
+                for i, text in enumerate(texts)
+            ],
+        )
+        docs = kept["documents"]
+        measure(
+            "tokens",
+            lambda: [
+                via_pickle(TokenStream.from_lines(d.text.split("\n"))) for d in docs
+            ],
+        )
+        measure(
+            "scopes",
+            lambda: [
+                via_pickle(build_scopes(d.get_line, tokens))
+                for d, tokens in zip(docs, kept["tokens"])
+            ],
+        )
+        measure(
+            "references",
+            lambda: [
+                build_references(d.get_line, tokens, scopes)
+                for d, tokens, scopes in zip(docs, kept["tokens"], kept["scopes"])
+            ],
+        )
+    finally:
+        tracemalloc.stop()
+
+    token_count = sum(len(tokens) for tokens in kept["tokens"])
+    return {
+        "files": file_count,
+        "lines": file_count * line_count,
+        "tokens": token_count,
+        "text_bytes": sum(len(text) for text in texts),
+        "bytes": sizes,
+        "bytes_per_document": round(sum(sizes.values()) / file_count),
+        "bytes_per_token": round(sizes["tokens"] / token_count, 1),
+    }
+
+
+def memory_report(d):
+    """Get a human readable report of the result of measure_memory()."""
+    files = d["files"]
+    lines = [
+        f"{files} open documents, {d['lines']} lines, {d['tokens']} tokens, "
+        f"{d['text_bytes'] / 2**20:0.1f} MB of text",
+        f"{'part':<12} {'total':>10} {'per doc':>10}",
+    ]
+    sizes = dict(d["bytes"], total=sum(d["bytes"].values()))
+    for name, size in sizes.items():
+        mb, kb = size / 2**20, size / files / 1024
+        lines.append(f"{name:<12} {mb:>7.2f} MB {kb:>7.1f} KB")
+    lines.append("")
+    lines.append(f"bytes per token:    {d['bytes_per_token']} (token stream)")
+    lines.append(f"bytes per document: {d['bytes_per_document']}")
+    return "\n".join(lines)
+
+
+# == Command line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pyserver.benchmark",
+        description="Record and replay LSP sessions, to benchmark the server.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("record", help="Record a session, as a proxy")
+    p.add_argument("trace")
+    p.add_argument("server", nargs=argparse.REMAINDER, help="the server command")
+
+    def add_session_args(p):
+        p.add_argument("--lines", type=int, default=10000)
+        p.add_argument("--bursts", type=int, default=20)
+        p.add_argument("--burst-length", type=int, default=12)
+        p.add_argument("--interval", type=float, default=0.03)
+        p.add_argument("--pause", type=float, default=0.5)
+        p.add_argument("--seed", type=int, default=0)
+
+    def add_replay_args(p):
+        p.add_argument("--speed", type=float, default=1.0, help="0 for max speed")
+        p.add_argument("--rate", type=float, default=None, help="messages/s")
+        p.add_argument("--timeout", type=float, default=30.0)
+        p.add_argument("--batch", type=int, default=1, help="max messages/batch")
+        p.add_argument("--json", action="store_true", help="output json")
+
+    p = commands.add_parser("generate", help="Generate a typing session")
+    p.add_argument("trace")
+    add_session_args(p)
+
+    p = commands.add_parser("replay", help="Replay a session, and report")
+    p.add_argument("trace")
+    add_replay_args(p)
+
+    p = commands.add_parser("run", help="Generate and replay a typing session")
+    add_session_args(p)
+    add_replay_args(p)
+
+    p = commands.add_parser("memory", help="Measure the memory of open documents")
+    p.add_argument("--files", type=int, default=100)
+    p.add_argument("--lines", type=int, default=500, help="lines per file")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", action="store_true", help="output json")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "memory":
+        result = measure_memory(args.files, args.lines, args.seed)
+        print(json.dumps(result, indent=2) if args.json else memory_report(result))
+        return 0
+
+    if args.command == "record":
+        server = args.server[1:] if args.server[:1] == ["--"] else args.server
+        return record(args.trace, server or SERVER_COMMAND)
+
+    if args.command in ("generate", "run"):
+        trace = make_session(
+            args.lines,
+            args.bursts,
+            args.burst_length,
+            args.interval,
+            args.pause,
+            args.seed,
+        )
+        if args.command == "generate":
+            write_trace(args.trace, trace)
+            return 0
+    else:
+        trace = read_trace(args.trace)
+
+    result = replay(trace, None, args.speed, args.rate, args.timeout, args.batch)
+    if args.json:
+        print(json.dumps(result.summary(), indent=2))
+    else:
+        print(result.report())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+Completion candidates, prebuilt once and indexed for prefix lookups.
+"""
+
+import re
+from collections import OrderedDict
+from bisect import bisect_left
+
+from .conv import itemkind2int
+
+
+KEYWORDS = [
+    "print",
+    "import",
+    "from",
+    "as",
+    # "and",  these are not really keywords
+    # "or",
+    # "true",
+    # "false",
+    # "nil",
+    "abstract",
+    "trait",
+    "struct",
+    "impl",
+    "func",
+    "proc",
+    "getter",
+    "setter",
+    "method",
+    "return",
+    "if",
+    "elif",
+    "elseif",
+    "else",
+    "then",
+    "for",
+    "in",
+    "while",
+    "do",
+    "its",
+    "break",
+    "continue",
+]
+
+# The max number of items in a response. If there are more candidates, the
+# list is marked incomplete, so the client asks again as the user types.
+MAX_ITEMS = 500
+
+# The max number of items, and of encoded items, that are cached. The least
+# recently used are dropped, so a long-lived server does not keep every
+# symbol it has seen.
+ITEM_CACHE_SIZE = 20000
+
+# The same identifiers as the lexer, which accepts Unicode
+_identifier_before = re.compile(r"[^\W\d]\w*$")
+
+
+def get_prefix(line, index):
+    """Get (prefix, is_member) for the identifier that ends at index.
+
+    is_member is True if the identifier is preceded by a dot.
+    """
+    before = line[:index]
+    m = _identifier_before.search(before)
+    prefix = m.group(0) if m else ""
+    is_member = before[: len(before) - len(prefix)].endswith(".")
+    return prefix, is_member
+
+
+class CompletionIndex:
+    """A sorted index of completion items, for fast prefix lookups.
+
+    The items are created once and shared between responses, so they must
+    not be modified.
+    """
+
+    def __init__(self, items=()):
+        self._keys = []  # sorted lowercase labels
+        self._items = []  # items in the same order
+        self._all = None  # (max_items, result) for the empty prefix
+        self.add(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, items):
+        pairs = list(zip(self._keys, self._items))
+        pairs.extend((item["label"].lower(), item) for item in items)
+        pairs.sort(key=lambda pair: pair[0])
+        self._keys = [pair[0] for pair in pairs]
+        self._items = [pair[1] for pair in pairs]
+        self._all = None
+
+    def lookup(self, prefix, max_items=MAX_ITEMS):
+        """Get (items, is_incomplete) for the items that start with prefix."""
+        if not prefix:
+            if self._all is None or self._all[0] != max_items:
+                result = self._items[:max_items], len(self._items) > max_items
+                self._all = max_items, result
+            return self._all[1]
+        key = prefix.lower()
+        i1 = bisect_left(self._keys, key)
+        # The highest code point, so that labels with astral characters after
+        # the prefix are included
+        i2 = bisect_left(self._keys, key + "\U0010ffff", i1)
+        if i2 - i1 > max_items:
+            return self._items[i1 : i1 + max_items], True
+        return self._items[i1:i2], False
+
+
+def make_keyword_item(name):
+    return {
+        "label": name,
+        "kind": itemkind2int("Keyword"),
+        "detail": "extra details",
+    }
+
+
+keyword_index = CompletionIndex(make_keyword_item(name) for name in KEYWORDS)
+
+
+# The completion item kind for each kind of definition
+_definition_kinds = {
+    "func": "Function",
+    "proc": "Function",
+    "method": "Method",
+    "getter": "Property",
+    "setter": "Property",
+    "struct": "Struct",
+    "trait": "Interface",
+    "parameter": "Variable",
+    "variable": "Variable",
+}
+_definition_items = OrderedDict()  # (name, kind) -> item, LRU
+
+
+def make_definition_item(name, kind):
+    key = name, kind
+    item = _definition_items.get(key, None)
+    if item is None:
+        item = {
+            "label": name,
+            "kind": itemkind2int(_definition_kinds.get(kind, "Text")),
+            "detail": kind,
+        }
+        _definition_items[key] = item
+        if len(_definition_items) > ITEM_CACHE_SIZE:
+            _definition_items.popitem(last=False)
+    else:
+        _definition_items.move_to_end(key)
+    return item
+
+
+def make_workspace_item(name, kind, filename):
+    return {
+        "label": name,
+        "kind": itemkind2int(_definition_kinds.get(kind, "Text")),
+        "detail": f"{kind} in {filename}",
+    }
+
+
+def definition_items(names, max_items=MAX_ITEMS):
+    """Get (items, is_incomplete) for the definitions that match a prefix.
+
+    The names are (name, kind) tuples from inner to outer scope, as from
+    ScopeIndex.names_at(), which are only consumed up to max_items. A name
+    that is defined in an inner scope hides the same name in outer scopes.
+    """
+    items = []
+    seen = set()
+    for name, kind in names:
+        if name in seen:
+            continue
+        if len(items) >= max_items:
+            return items, True
+        seen.add(name)
+        items.append(make_definition_item(name, kind))
+    return items, False
+
+
+# The items are shared between responses, so their JSON is cached too, by
+# (label, kind, detail), which is all that is in an item. LRU, like the items.
+_encoded_items = OrderedDict()
+
+
+def encode_completion_list(items, is_incomplete, encode):
+    """Encode a CompletionList as JSON bytes, using the given encode function
+    for items that have not been encoded before.
+    """
+    cache = _encoded_items
+    parts = []
+    for item in items:
+        key = item["label"], item["kind"], item["detail"]
+        bb = cache.get(key, None)
+        if bb is None:
+            bb = cache[key] = encode(item)
+            if len(cache) > ITEM_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        parts.append(bb)
+    if is_incomplete:
+        head = b'{"isIncomplete":true,"items":['
+    else:
+        head = b'{"isIncomplete":false,"items":['
+    return head + b",".join(parts) + b"]}"
@@ -1,29 +1,65 @@
+COMPLETION_ITEM_KINDS = {
+    "Text": 1,
+    "Method": 2,
+    "Function": 3,
+    "Constructor": 4,
+    "Field": 5,
+    "Variable": 6,
+    "Class": 7,
+    "Interface": 8,
+    "Module": 9,
+    "Property": 10,
+    "Unit": 11,
+    "Value": 12,
+    "Enum": 13,
+    "Keyword": 14,
+    "Snippet": 15,
+    "Color": 16,
+    "File": 17,
+    "Reference": 18,
+    "Folder": 19,
+    "EnumMember": 20,
+    "Constant": 21,
+    "Struct": 22,
+    "Event": 23,
+    "Operator": 24,
+    "TypeParameter": 25,
+}
+
+
 def itemkind2int(kind):
-    m = {
-        "Text": 1,
-        "Method": 2,
-        "Function": 3,
-        "Constructor": 4,
-        "Field": 5,
-        "Variable": 6,
-        "Class": 7,
-        "Interface": 8,
-        "Module": 9,
-        "Property": 10,
-        "Unit": 11,
-        "Value": 12,
-        "Enum": 13,
-        "Keyword": 14,
-        "Snippet": 15,
-        "Color": 16,
-        "File": 17,
-        "Reference": 18,
-        "Folder": 19,
-        "EnumMember": 20,
-        "Constant": 21,
-        "Struct": 22,
-        "Event": 23,
-        "Operator": 24,
-        "TypeParameter": 25,
-    }
-    return m[kind]
+    return COMPLETION_ITEM_KINDS[kind]
+
+
+SYMBOL_KINDS = {
+    "File": 1,
+    "Module": 2,
+    "Namespace": 3,
+    "Package": 4,
+    "Class": 5,
+    "Method": 6,
+    "Property": 7,
+    "Field": 8,
+    "Constructor": 9,
+    "Enum": 10,
+    "Interface": 11,
+    "Function": 12,
+    "Variable": 13,
+    "Constant": 14,
+    "String": 15,
+    "Number": 16,
+    "Boolean": 17,
+    "Array": 18,
+    "Object": 19,
+    "Key": 20,
+    "Null": 21,
+    "EnumMember": 22,
+    "Struct": 23,
+    "Event": 24,
+    "Operator": 25,
+    "TypeParameter": 26,
+}
+
+
+def symbolkind2int(kind):
+    return SYMBOL_KINDS[kind]
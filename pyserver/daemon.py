@@ -0,0 +1,136 @@
+"""
+A daemon that serves multiple clients over TCP, from a single process.
+
+Each connection gets its own session (a LanguageServer), with the state of
+that client: its capabilities, open documents, pending requests, etc. The
+sessions share the worker processes, the cache of analysis results, and
+the workspace indexes (one per set of workspace folders). So with several
+editor windows on the same workspace, the workspace is indexed once, and a
+file that is open in several windows is analysed once.
+
+Any local process can connect, so the files that a client can have the
+daemon write (the index cache, profiles) must be in its cache directory.
+
+When the last client has disconnected, the daemon waits for idle_timeout
+seconds, and stops if no client connected in the mean time.
+"""
+
+import asyncio
+
+from .utils import logger
+from .startup import StartupTimer
+from .transport import serve_tcp
+from .analysis import WorkerPool
+from .workspace import get_folder_paths
+from .server import LanguageServer
+
+
+DEFAULT_IDLE_TIMEOUT = 600.0  # seconds
+
+
+class Daemon:
+    """Accepts LSP connections, and runs a session for each."""
+
+    def __init__(
+        self, startup=None, report_startup=False, idle_timeout=DEFAULT_IDLE_TIMEOUT
+    ):
+        self.startup = startup or StartupTimer()
+        self.report_startup = report_startup
+        self.idle_timeout = idle_timeout  # seconds, 0 means never stop
+        self.pool = WorkerPool()
+        self.loop = None
+        self.sessions = {}  # Connection -> LanguageServer
+        self._workspaces = {}  # tuple of folder paths -> [WorkspaceIndex, count]
+        self._session_count = 0
+        self._server = None
+        self._idle_handle = None
+
+    def start(self, host="127.0.0.1", port=8339):
+        """Run the daemon, until it has been idle for too long."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        callbacks = self._on_message, self._on_close, self._on_connect
+        self._server = self.loop.run_until_complete(serve_tcp(host, port, *callbacks))
+        self.startup.mark("transport ready")
+        self._schedule_idle_stop()
+        logger.info("Entering main loop")
+        try:
+            self.loop.run_forever()
+        finally:
+            self.shutdown()
+        logger.info("Main loop ended")
+
+    def shutdown(self):
+        self._server.close()
+        for connection in list(self.sessions):
+            connection.close()
+        for index, _ in self._workspaces.values():
+            index.shutdown()
+        self._workspaces.clear()
+        self.pool.shutdown()
+
+    # Connections
+
+    def _on_connect(self, connection):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        # The first session reports the startup of the daemon
+        startup = self.startup if self._session_count == 0 else None
+        session = LanguageServer(startup, self.report_startup, daemon=self)
+        session._on_connect(connection)
+        self.sessions[connection] = session
+        self._session_count += 1
+        logger.info(f"Session started, {len(self.sessions)} active")
+
+    def _on_message(self, connection, payload):
+        session = self.sessions.get(connection, None)
+        if session is not None:
+            session._on_message(connection, payload)
+
+    def _on_close(self, connection):
+        session = self.sessions.pop(connection, None)
+        if session is None:
+            return
+        session.close_session()
+        logger.info(f"Session ended, {len(self.sessions)} active")
+        if not self.sessions:
+            self._schedule_idle_stop()
+
+    def _schedule_idle_stop(self):
+        if self.idle_timeout > 0:
+            self._idle_handle = self.loop.call_later(
+                self.idle_timeout, self._stop_if_idle
+            )
+
+    def _stop_if_idle(self):
+        self._idle_handle = None
+        if not self.sessions:
+            logger.warning(f"No clients for {self.idle_timeout:0.0f} s, stopping")
+            self.loop.stop()
+
+    # Shared workspace indexes
+
+    def get_workspace(self, index, workspace_folders, root_uri=None):
+        """Get the shared index for the given workspace folders. If there is
+        none, the given (new) index is started, and becomes the shared one.
+        """
+        key = tuple(sorted(get_folder_paths(workspace_folders, root_uri)))
+        entry = self._workspaces.get(key, None)
+        if entry is None:
+            index.start(workspace_folders, root_uri)
+            entry = self._workspaces[key] = [index, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release_workspace(self, index):
+        """Release an index that a session got from get_workspace(). It is
+        shut down when no session uses it.
+        """
+        for key, entry in self._workspaces.items():
+            if entry[0] is index:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._workspaces[key]
+                    index.shutdown()
+                return
@@ -0,0 +1,135 @@
+"""
+Diagnostics, derived from the analysis results, and published to the client.
+
+When a new analysis result is available for a document, its diagnostics are
+computed and compared with the set that was last published for that
+document. Nothing is sent when they are the same, which is the common case
+while typing in code without errors.
+
+Publishes are also rate-limited per document: the first change is published
+right away, and further changes within the interval are coalesced into one
+publish at the end of it, for the latest analysis. So a burst of keystrokes
+results in a few notifications instead of one per keystroke, and the last
+version is always published.
+"""
+
+import time
+import asyncio
+
+from . import lexer
+
+
+DEFAULT_INTERVAL = 0.5  # min seconds between publishes per document
+
+# DiagnosticSeverity
+ERROR = 1
+WARNING = 2
+
+
+def compute_diagnostics(doc, analysis):
+    """Get a list of Diagnostic dicts for an up-to-date analysis."""
+    tokens = analysis.tokens
+    kinds = tokens.kinds.tobytes()  # to search at C speed
+    diagnostics = []
+    i = kinds.find(lexer.ERROR)
+    while i >= 0:
+        line = tokens.line_of(i)
+        text = doc.get_line(line)
+        column, length = tokens.columns[i], tokens.lengths[i]
+        if text.startswith("'", column):
+            message = "Unterminated string"
+        else:
+            message = f"Invalid character {text[column : column + length]!r}"
+        start = doc.to_character(line, column)
+        end = doc.to_character(line, column + length)
+        diagnostics.append(
+            {
+                "range": {
+                    "start": {"line": line, "character": start},
+                    "end": {"line": line, "character": end},
+                },
+                "severity": ERROR,
+                "source": "zoof",
+                "message": message,
+            }
+        )
+        i = kinds.find(lexer.ERROR, i + 1)
+    return diagnostics
+
+
+class DiagnosticsPublisher:
+    """Publishes the diagnostics of the open documents, throttled and diffed."""
+
+    def __init__(self, server):
+        self._server = server
+        self.interval = DEFAULT_INTERVAL
+        self._published = {}  # uri -> list of diagnostics
+        self._last_time = {}  # uri -> time of the last publish
+        self._pending = {}  # uri -> task that publishes at the end of the interval
+        self.published = 0  # number of publishDiagnostics sent
+        self.unchanged = 0  # number of results with the same diagnostics
+        self.coalesced = 0  # number of results that were throttled
+
+    def configure(self, options):
+        """Apply initialization options."""
+        options = options or {}
+        self.interval = float(options.get("diagnosticsInterval", self.interval))
+
+    def get_stats(self):
+        return {
+            "published": self.published,
+            "unchanged": self.unchanged,
+            "coalesced": self.coalesced,
+        }
+
+    def update(self, uri):
+        """Call when there is a new analysis result for the document."""
+        if uri in self._pending:
+            self.coalesced += 1
+            return  # the pending publish will use the latest result
+        wait = self._last_time.get(uri, 0.0) + self.interval - time.perf_counter()
+        if wait > 0:
+            self.coalesced += 1
+            loop = asyncio.get_running_loop()
+            self._pending[uri] = loop.create_task(self._publish_later(uri, wait))
+        else:
+            self._publish(uri)
+
+    def close(self, uri):
+        """Clear the diagnostics of a document that was closed."""
+        pending = self._pending.pop(uri, None)
+        if pending is not None:
+            pending.cancel()
+        self._last_time.pop(uri, None)
+        if self._published.pop(uri, None):
+            self._send(uri, None, [])
+
+    def shutdown(self):
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+
+    async def _publish_later(self, uri, wait):
+        await asyncio.sleep(wait)
+        self._pending.pop(uri, None)
+        self._publish(uri)
+
+    def _publish(self, uri):
+        doc = self._server.documents.get(uri)
+        analysis = self._server.analyzer.get_result(uri)
+        if doc is None or analysis is None or analysis.version != doc.version:
+            return  # the result for the current version will come
+        diagnostics = compute_diagnostics(doc, analysis)
+        if diagnostics == self._published.get(uri, []):
+            self.unchanged += 1
+            return
+        self._published[uri] = diagnostics
+        self._last_time[uri] = time.perf_counter()
+        self._send(uri, doc.version, diagnostics)
+
+    def _send(self, uri, version, diagnostics):
+        params = {"uri": uri, "diagnostics": diagnostics}
+        if version is not None:
+            params["version"] = version
+        self.published += 1
+        self._server.send_notification("textDocument/publishDiagnostics", params)
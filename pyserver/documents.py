@@ -0,0 +1,262 @@
+"""
+The in-memory store of open documents, kept in sync with the client.
+
+The text of a document is stored as a list of lines (each line including its
+line ending). A ranged edit only touches the lines in its range, so typing a
+character does not copy the whole document.
+
+Each document also keeps a log of which lines were replaced in each version,
+so that derived data (like the tokens) can be updated incrementally.
+
+Positions are in the code units of the position encoding that was agreed
+with the client. Python strings are indexed by code point, so with utf-32
+the character of a position is the str index. With utf-16 (the default) or
+utf-8, the two are the same on ASCII lines, which are the vast majority. For
+the other lines, a table with the code unit offset of each str index is
+cached, so a conversion is a lookup one way, and a bisect the other way.
+"""
+
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from .utils import logger
+
+
+# When the edit log gets longer than this, it is dropped.
+MAX_EDIT_LOG = 1000
+
+# The position encodings that we support, in order of preference.
+POSITION_ENCODINGS = ["utf-32", "utf-8", "utf-16"]
+DEFAULT_ENCODING = "utf-16"  # the encoding to use if the client says nothing
+
+
+def split_lines(text):
+    """Split text into lines that include the "\\n". The last line has no
+    line ending (and may be empty), so there is always at least one line.
+    """
+    parts = text.split("\n")
+    lines = [part + "\n" for part in parts[:-1]]
+    lines.append(parts[-1])
+    return lines
+
+
+def negotiate_encoding(client_encodings):
+    """Select the position encoding, from the list of encodings that the
+    client supports (general.positionEncodings), which may be None.
+    """
+    for encoding in POSITION_ENCODINGS:
+        if encoding in (client_encodings or ()):
+            return encoding
+    return DEFAULT_ENCODING
+
+
+def make_unit_table(text, encoding):
+    """Get an array with the offset in code units of each str index in the
+    text, plus one for the end of the text.
+    """
+    if encoding == "utf-16":
+        widths = (1 if c <= "\uffff" else 2 for c in text)
+    else:
+        widths = (
+            1 if c < "\x80" else 2 if c < "\u0800" else 3 if c <= "\uffff" else 4
+            for c in text
+        )
+    # Two bytes per offset is enough for all but very long lines
+    typecode = "H" if len(text) < 16000 else "I"
+    return array(typecode, accumulate(widths, initial=0))
+
+
+def count_units(text, encoding):
+    """Get the length of the text, in code units of the encoding."""
+    if encoding == "utf-32" or text.isascii():
+        return len(text)
+    elif encoding == "utf-16":
+        return len(text.encode("utf-16-le", "surrogatepass")) // 2
+    return len(text.encode("utf-8", "surrogatepass"))
+
+
+class Document:
+    """A text document that is open in the client."""
+
+    __slots__ = [
+        "uri",
+        "version",
+        "language_id",
+        "encoding",
+        "_lines",
+        "_text",
+        "_unit_tables",
+        "_edits",
+        "_edits_since",
+    ]
+
+    def __init__(
+        self, uri, version, text, language_id=None, encoding=DEFAULT_ENCODING
+    ):
+        self.uri = uri
+        self.version = version
+        self.language_id = language_id
+        self.encoding = encoding  # the position encoding
+        self._lines = split_lines(text)
+        self._text = text
+        # line text -> unit table, for non-ASCII lines. The tables of lines
+        # that are replaced are dropped, so all keys are current lines.
+        self._unit_tables = {}
+        self._edits = []  # (version, line, removed line count, added line count)
+        self._edits_since = version  # the version at the start of the log
+
+    def __repr__(self):
+        return f"<Document {self.uri} v{self.version}>"
+
+    @property
+    def text(self):
+        """The full text of the document."""
+        if self._text is None:
+            self._text = "".join(self._lines)
+        return self._text
+
+    @property
+    def line_count(self):
+        return len(self._lines)
+
+    def get_line(self, line):
+        """Get the text of a line, without line ending."""
+        return self._lines[line].rstrip("\r\n")
+
+    # Positions
+
+    def get_units(self, line):
+        """Get the unit table of a line (see make_unit_table), or None if
+        the characters of positions on that line are str indices.
+        """
+        text = self._lines[line]
+        if self.encoding == "utf-32" or text.isascii():
+            return None
+        table = self._unit_tables.get(text, None)
+        if table is None:
+            table = self._unit_tables[text] = make_unit_table(text, self.encoding)
+        return table
+
+    def to_index(self, line, character):
+        """Convert the character of a position on a line to a str index."""
+        units = self.get_units(line)
+        if units is None:
+            return character
+        # A character in the middle of a code point rounds up
+        return min(bisect_left(units, character), len(units) - 1)
+
+    def to_character(self, line, index):
+        """Convert a str index on a line to the character of a position."""
+        units = self.get_units(line)
+        if units is None:
+            return index
+        return units[min(index, len(units) - 1)]
+
+    def _clamp(self, position):
+        """Convert an LSP position to a (line, index), clamped to the text."""
+        line = position["line"]
+        if line < 0:
+            return 0, 0
+        elif line >= len(self._lines):
+            line = len(self._lines) - 1
+            return line, len(self._lines[line])
+        index = self.to_index(line, position["character"])
+        return line, min(index, len(self._lines[line].rstrip("\r\n")))
+
+    # Edits
+
+    def apply_changes(self, version, changes):
+        """Apply a list of TextDocumentContentChangeEvent's, and set the version."""
+        for change in changes:
+            edit = self.apply_change(change)
+            self._edits.append((version, *edit))
+        self.version = version
+        if len(self._edits) > MAX_EDIT_LOG:
+            self._edits.clear()
+            self._edits_since = version
+
+    def get_edits(self, since_version):
+        """Get the edits since the given version, as a list of tuples
+        (line, removed line count, added line count). Returns None if the
+        log does not go back that far.
+        """
+        if since_version is None or self._edits_since is None:
+            return None
+        elif since_version < self._edits_since:
+            return None
+        return [edit[1:] for edit in self._edits if edit[0] > since_version]
+
+    def drop_edits(self, upto_version):
+        """Drop the edits up to (and including) the given version."""
+        if upto_version is None or self._edits_since is None:
+            return
+        self._edits = [edit for edit in self._edits if edit[0] > upto_version]
+        self._edits_since = max(self._edits_since, upto_version)
+
+    def apply_change(self, change):
+        """Apply a TextDocumentContentChangeEvent (ranged or full).
+
+        Returns (line, removed line count, added line count).
+        """
+        if "range" not in change:
+            old_count = len(self._lines)
+            self._lines = split_lines(change["text"])
+            self._text = change["text"]
+            self._unit_tables.clear()
+            return 0, old_count, len(self._lines)
+
+        lines = self._lines
+        line0, index0 = self._clamp(change["range"]["start"])
+        line1, index1 = self._clamp(change["range"]["end"])
+        if (line1, index1) < (line0, index0):
+            line0, index0, line1, index1 = line1, index1, line0, index0
+
+        new = lines[line0][:index0] + change["text"] + lines[line1][index1:]
+        new_lines = split_lines(new)
+        if line1 < len(lines) - 1:
+            new_lines.pop()  # new ends with "\n", so the last part is empty
+        if self._unit_tables:
+            for text in lines[line0 : line1 + 1]:
+                self._unit_tables.pop(text, None)
+        lines[line0 : line1 + 1] = new_lines
+
+        self._text = None
+        return line0, line1 - line0 + 1, len(new_lines)
+
+
+class DocumentStore:
+    """Keeps the open documents, by uri."""
+
+    def __init__(self):
+        self._documents = {}
+        self.encoding = DEFAULT_ENCODING  # the position encoding of new documents
+
+    def __contains__(self, uri):
+        return uri in self._documents
+
+    def __len__(self):
+        return len(self._documents)
+
+    def get(self, uri):
+        """Get the document for the given uri, or None."""
+        return self._documents.get(uri, None)
+
+    def open(self, uri, version, text, language_id=None):
+        doc = Document(uri, version, text, language_id, self.encoding)
+        self._documents[uri] = doc
+        return doc
+
+    def change(self, uri, version, changes):
+        doc = self._documents.get(uri, None)
+        if doc is None:
+            logger.warning(f"Got changes for a document that is not open: {uri}")
+            return None
+        if version is not None and doc.version is not None:
+            if version <= doc.version:
+                logger.warning(f"Got version {version} for {doc}")
+        doc.apply_changes(version, changes)
+        return doc
+
+    def close(self, uri):
+        return self._documents.pop(uri, None)
@@ -0,0 +1,27 @@
+"""
+JSON-RPC / LSP error codes, and an exception to raise them from method handlers.
+"""
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+SERVER_NOT_INITIALIZED = -32002
+UNKNOWN_ERROR_CODE = -32001
+
+REQUEST_FAILED = -32803
+SERVER_CANCELLED = -32802
+CONTENT_MODIFIED = -32801
+REQUEST_CANCELLED = -32800
+
+
+class RequestError(Exception):
+    """Raise this in a method handler to respond with a specific error code."""
+
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
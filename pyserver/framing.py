@@ -0,0 +1,89 @@
+"""
+Framing of JSON-RPC messages (the base protocol of LSP).
+
+Each message is a header block, terminated by an empty line, followed by
+Content-Length bytes of content.
+"""
+
+from .utils import logger
+
+
+HEADER_END = b"\r\n\r\n"
+EXPECTED_CONTENT_TYPE = b"application/vscode-jsonrpc; charset=utf-8"
+
+# Compact the buffer when this many bytes have been consumed.
+COMPACT_THRESHOLD = 2**16
+
+
+def make_header(content_length):
+    """Get the header bytes for a message with the given content length."""
+    return b"Content-Length: %d\r\n\r\n" % content_length
+
+
+class FrameParser:
+    """Incremental parser that turns a stream of bytes into message payloads.
+
+    Feed it chunks of any size; a chunk may contain a part of a message, or
+    several messages. The payloads are returned as bytes objects, which can
+    be passed straight to the JSON decoder.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0  # start of the unconsumed data
+        self._content_length = -1  # >= 0 while waiting for content
+
+    def feed(self, data):
+        """Add data and return a list of complete payloads (may be empty)."""
+        buffer = self._buffer
+        buffer += data
+        payloads = []
+
+        # Slicing a memoryview does not copy, so each payload is copied once
+        with memoryview(buffer) as view:
+            while True:
+                if self._content_length < 0:
+                    i = buffer.find(HEADER_END, self._pos)
+                    if i < 0:
+                        break
+                    self._content_length = self._parse_header(view, self._pos, i)
+                    self._pos = i + len(HEADER_END)
+                else:
+                    end = self._pos + self._content_length
+                    if end > len(buffer):
+                        break
+                    if self._content_length > 0:
+                        payloads.append(bytes(view[self._pos : end]))
+                    self._pos = end
+                    self._content_length = -1
+
+        # Drop consumed data. Doing this only once in a while (or when all
+        # data is consumed) avoids moving memory for every message.
+        if self._pos == len(buffer):
+            buffer.clear()
+            self._pos = 0
+        elif self._pos >= COMPACT_THRESHOLD:
+            del buffer[: self._pos]
+            self._pos = 0
+
+        return payloads
+
+    def _parse_header(self, view, start, end):
+        content_length = 0
+        for line in bytes(view[start:end]).split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    logger.error(f"Could not parse Content-Length: {line!r}")
+            elif name == b"content-type":
+                if value.strip() != EXPECTED_CONTENT_TYPE:
+                    logger.warning(f"Unexpected Content-Type: {line!r}")
+            else:
+                logger.warning(f"Ignoring incoming header line: {line!r}")
+        if content_length <= 0:
+            logger.error("Got a message with Content-Length zero")
+            content_length = 0
+        return content_length
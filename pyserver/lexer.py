@@ -0,0 +1,322 @@
+"""
+A lexer for Zoof source code, used for highlighting and structural analysis.
+
+It follows the TextMate grammar in syntaxes/zoof.tmLanguage.json. The lexer
+works line by line. A small state carries over from one line to the next
+(whether we are inside a "#### output" block), so that lexing can be
+(re)started at the beginning of any line.
+
+The TokenStream keeps the tokens in flat arrays, together with the number of
+tokens and the lexer state at the start of each line. After an edit, only
+the edited lines are lexed again, and lexing stops as soon as the state at
+the start of a line matches the state from before the edit. The tokens of
+the other lines are reused.
+"""
+
+import re
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+
+# Token kinds
+KEYWORD = 0
+OPERATOR = 1
+CONSTANT = 2
+NUMBER = 3
+STRING = 4
+COMMENT = 5
+IDENTIFIER = 6
+PUNCTUATION = 7
+ERROR = 8
+
+TOKEN_KINDS = [
+    "keyword",
+    "operator",
+    "constant",
+    "number",
+    "string",
+    "comment",
+    "identifier",
+    "punctuation",
+    "error",
+]
+
+# Lexer states
+NORMAL = 0
+IN_OUTPUT_BLOCK = 1
+
+KEYWORDS = {
+    "import",
+    "from",
+    "as",
+    "abstract",
+    "trait",
+    "struct",
+    "impl",
+    "func",
+    "getter",
+    "setter",
+    "method",
+    "return",
+    "if",
+    "elif",
+    "elseif",
+    "else",
+    "then",
+    "for",
+    "in",
+    "while",
+    "do",
+    "its",
+    "break",
+    "continue",
+    "proc",
+}
+OPERATOR_WORDS = {"and", "or", "not"}
+CONSTANTS = {"true", "false", "nil"}
+
+_token_re = re.compile(
+    r"""
+    (?P<ws>\s+)
+    |(?P<comment>\#.*)
+    |(?P<string>'[^']*')
+    |(?P<badstring>'.*)
+    |(?P<number>\d+(?:\.\d+)?)
+    |(?P<name>[^\W\d]\w*)
+    |(?P<operator>==|!=|<=|>=|->|=>|[-+*/%<>=!&|^~])
+    |(?P<punctuation>[.,:;()\[\]{}@])
+    |(?P<error>.)
+    """,
+    re.VERBOSE,
+)
+_output_begin_re = re.compile(r"####\soutput")
+_output_end_re = re.compile(r"####\send")
+
+_simple_kinds = {
+    "string": STRING,
+    "badstring": ERROR,
+    "number": NUMBER,
+    "operator": OPERATOR,
+    "punctuation": PUNCTUATION,
+    "error": ERROR,
+}
+
+
+def tokenize_line(line, state=NORMAL):
+    """Tokenize a single line (without line ending).
+
+    Returns (tokens, state), with tokens a list of (column, length, kind),
+    and state the lexer state at the start of the next line. Columns are
+    str indices.
+    """
+    tokens = []
+    pos = 0
+    n = len(line)
+
+    if state == IN_OUTPUT_BLOCK:
+        m = _output_end_re.search(line)
+        if m is None:
+            if n:
+                tokens.append((0, n, COMMENT))
+            return tokens, IN_OUTPUT_BLOCK
+        pos = m.end()
+        tokens.append((0, pos, COMMENT))
+
+    match = _token_re.match
+    while pos < n:
+        m = match(line, pos)
+        group = m.lastgroup
+        end = m.end()
+        if group == "ws":
+            pass
+        elif group == "name":
+            word = m.group()
+            if word in KEYWORDS:
+                kind = KEYWORD
+            elif word in OPERATOR_WORDS:
+                kind = OPERATOR
+            elif word in CONSTANTS:
+                kind = CONSTANT
+            else:
+                kind = IDENTIFIER
+            tokens.append((pos, end - pos, kind))
+        elif group == "comment":
+            tokens.append((pos, end - pos, COMMENT))
+            if _output_begin_re.match(line, pos):
+                return tokens, IN_OUTPUT_BLOCK
+        else:
+            tokens.append((pos, end - pos, _simple_kinds[group]))
+        pos = end
+
+    return tokens, NORMAL
+
+
+def tokenize_lines(lines, state=NORMAL):
+    """Tokenize a sequence of lines (without line endings).
+
+    Generates (tokens, state) for each line, where state is the state at
+    the start of that line.
+    """
+    for line in lines:
+        tokens, next_state = tokenize_line(line, state)
+        yield tokens, state
+        state = next_state
+
+
+class TokenStream:
+    """The tokens of a document, with the lexer state per line.
+
+    The tokens are stored in parallel arrays, in document order: the column
+    (str index into the line), the length and the kind of each token. Per
+    line, the number of tokens and the state at the start of the line are
+    stored. This takes about 9 bytes per token, instead of a tuple per line
+    and an int object per column.
+    """
+
+    __slots__ = [
+        "columns",
+        "lengths",
+        "kinds",
+        "line_counts",
+        "line_states",
+        "_offsets",
+    ]
+
+    def __init__(self, columns, lengths, kinds, line_counts, line_states):
+        self.columns = columns  # array("I")
+        self.lengths = lengths  # array("I")
+        self.kinds = kinds  # array("B")
+        self.line_counts = line_counts  # array("I"), number of tokens per line
+        self.line_states = line_states  # bytearray, state at the start of a line
+        # The index of the first token of each line, valid up to its length.
+        # It is extended when needed, and cut at the first line of an edit.
+        self._offsets = array("I", [0])
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Create a token stream from a sequence of lines (without line endings)."""
+        columns, lengths, kinds = array("I"), array("I"), array("B")
+        line_counts = array("I")
+        line_states = bytearray()
+        for tokens, state in tokenize_lines(lines):
+            for column, length, kind in tokens:
+                columns.append(column)
+                lengths.append(length)
+                kinds.append(kind)
+            line_counts.append(len(tokens))
+            line_states.append(state)
+        return cls(columns, lengths, kinds, line_counts, line_states)
+
+    def __len__(self):
+        """The number of tokens."""
+        return len(self.kinds)
+
+    @property
+    def line_count(self):
+        return len(self.line_counts)
+
+    def _get_offset(self, line):
+        """Get the index of the first token of the given line (which may be
+        the line count, for the end).
+        """
+        offsets = self._offsets
+        if len(offsets) <= line:
+            start = len(offsets) - 1
+            counts = self.line_counts[start:line]
+            offsets.extend(accumulate(counts, initial=offsets[start]))
+            del offsets[start]  # the initial value was there already
+        return offsets[line]
+
+    def line_range(self, line):
+        """Get the (start, end) indices of the tokens of the given line."""
+        return self._get_offset(line), self._get_offset(line + 1)
+
+    def line_of(self, i):
+        """Get the line of the token with index i."""
+        self._get_offset(len(self.line_counts))
+        return bisect_right(self._offsets, i) - 1
+
+    def iter_tokens(self, first_line=0, last_line=None):
+        """Generate (line, column, length, kind) for the tokens in the line range."""
+        if last_line is None:
+            last_line = len(self.line_counts) - 1
+        columns, lengths, kinds = self.columns, self.lengths, self.kinds
+        line_counts = self.line_counts
+        i = self.line_range(first_line)[0]
+        for line in range(first_line, last_line + 1):
+            end = i + line_counts[line]
+            while i < end:
+                yield line, columns[i], lengths[i], kinds[i]
+                i += 1
+
+    def update(self, get_line, line_count, edits):
+        """Update the tokens for the given edits.
+
+        The edits are (line, removed line count, added line count) tuples, as
+        produced by Document.get_edits(). get_line(i) returns the text of line
+        i in the new version of the document. Returns the number of lines
+        that were lexed.
+        """
+        columns, lengths, kinds = self.columns, self.lengths, self.kinds
+        line_counts = self.line_counts
+        line_states = self.line_states
+        offsets = self._offsets
+
+        # Remove the tokens of the edited lines, and keep track of the
+        # (start, end) ranges of new lines, in the line numbers after the
+        # edits so far. The state at the start of the first line of an edit
+        # is not affected by the edit itself.
+        dirty = []
+        for line, removed, added in edits:
+            i0 = self._get_offset(line)
+            i1 = i0 + sum(line_counts[line : line + removed])
+            del columns[i0:i1], lengths[i0:i1], kinds[i0:i1]
+            del offsets[line + 1 :]
+            line_counts[line : line + removed] = array("I", [0]) * added
+            line_states[line + 1 : line + removed] = bytes(max(0, added - 1))
+            end, delta = line + removed, added - removed
+            new_start, new_end = line, line + added
+            ranges = []
+            for start, stop in dirty:
+                if stop <= line:
+                    ranges.append((start, stop))
+                elif start >= end:
+                    ranges.append((start + delta, stop + delta))
+                else:  # overlaps the edit, merge with the new lines
+                    new_start = min(new_start, start)
+                    new_end = max(new_end, stop + delta)
+            ranges.append((new_start, new_end))
+            dirty = ranges
+        assert len(line_counts) == line_count
+
+        # Lex the dirty lines, until the state matches the old state again.
+        # The tokens of each run of lexed lines are replaced in one go.
+        count = 0
+        line = 0
+        for start, stop in sorted(dirty):
+            if stop <= line:
+                continue  # lexed in the previous run
+            line = max(line, start)
+            i0 = i1 = self._get_offset(line)
+            del offsets[line + 1 :]  # the counts of the next lines change
+            new_columns, new_lengths, new_kinds = array("I"), array("I"), array("B")
+            state = line_states[line]
+            while line < line_count:
+                tokens, state = tokenize_line(get_line(line), state)
+                for column, length, kind in tokens:
+                    new_columns.append(column)
+                    new_lengths.append(length)
+                    new_kinds.append(kind)
+                i1 += line_counts[line]
+                line_counts[line] = len(tokens)
+                count += 1
+                line += 1
+                if line < line_count:
+                    if line >= stop and line_states[line] == state:
+                        break
+                    line_states[line] = state
+            columns[i0:i1] = new_columns
+            lengths[i0:i1] = new_lengths
+            kinds[i0:i1] = new_kinds
+        return count
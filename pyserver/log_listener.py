@@ -10,4 +10,4 @@ sock.bind(("127.0.0.1", 12012))
 
 while True:
     data, addr = sock.recvfrom(2**20)
-    print(data.decode())
+    print(data.decode(errors="replace"))
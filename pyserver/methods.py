@@ -1,67 +1,221 @@
-from .server import register_method
+from .server import register_method, codec
 from .utils import logger, print
-from .conv import itemkind2int
+from .errors import RequestError, CONTENT_MODIFIED
+from .references import build_references
+from .outline import build_outline
+from .completion import keyword_index, definition_items, get_prefix, MAX_ITEMS
+from .completion import encode_completion_list
 
 
 @register_method
 async def textDocument_didOpen(server, params):
+    d = params["textDocument"]
+    server.documents.open(d["uri"], d.get("version"), d["text"], d.get("languageId"))
+    server.analyzer.schedule(d["uri"], 0)
     return None  # This is a notification
 
 
 @register_method
 async def textDocument_didChange(server, params):
+    d = params["textDocument"]
+    server.documents.change(d["uri"], d.get("version"), params["contentChanges"])
+    server.analyzer.schedule(d["uri"])
     return None  # This is a notification
 
 
 @register_method
 async def textDocument_didClose(server, params):
+    uri = params["textDocument"]["uri"]
+    server.analyzer.close(uri)
+    server.semantic_tokens.close(uri)
+    server.diagnostics.close(uri)
+    server.documents.close(uri)
     return None  # This is a notification
 
 
 @register_method
 async def textDocument_completion(server, params):
-    items = []
-    for name in [
-        "print",
-        "import",
-        "from",
-        "as",
-        # "and",  these are not really keywords
-        # "or",
-        # "true",
-        # "false",
-        # "nil",
-        "abstract",
-        "trait",
-        "struct",
-        "impl",
-        "func",
-        "proc",
-        "getter",
-        "setter",
-        "method",
-        "return",
-        "if",
-        "elif",
-        "elseif",
-        "else",
-        "then",
-        "for",
-        "in",
-        "while",
-        "do",
-        "its",
-        "break",
-        "continue",
-    ]:
-        item = {
-            "label": name,
-            "kind": itemkind2int("Keyword"),
-            "detail": "extra details",
-        }
-        items.append(item)
-    result = {
-        "isIncomplete": False,
-        "items": items,
+    prefix, is_member = "", False
+    uri = params["textDocument"]["uri"]
+    doc = server.documents.get(uri)
+    position = params["position"]
+    if doc is not None:
+        if position["line"] < doc.line_count:
+            line = doc.get_line(position["line"])
+            index = doc.to_index(position["line"], position["character"])
+            prefix, is_member = get_prefix(line, index)
+
+    if is_member:
+        # Attributes depend on the type of the object, which is not known
+        items, is_incomplete = [], False
+    else:
+        items, is_incomplete = keyword_index.lookup(prefix)
+        # Don't wait for the analysis, the last result is good enough
+        analysis = server.analyzer.get_result(uri)
+        if analysis is not None:
+            names = analysis.scopes.names_at(position["line"], prefix)
+            more, more_incomplete = definition_items(names, MAX_ITEMS - len(items))
+            items = more + items
+            is_incomplete = is_incomplete or more_incomplete
+        # Definitions in other files
+        if prefix and len(items) < MAX_ITEMS:
+            labels = {item["label"] for item in items}
+            more, more_incomplete = server.workspace.completion_items(
+                prefix, MAX_ITEMS - len(items)
+            )
+            items = items + [item for item in more if item["label"] not in labels]
+            is_incomplete = is_incomplete or more_incomplete
+
+    # The items are pre-encoded, so the result is bytes
+    return encode_completion_list(items, is_incomplete, codec.encode)
+
+
+async def get_analysis(server, params):
+    """Get (doc, analysis) for the current version of the document.
+
+    Returns (doc, None) if the document is not open or cannot be analysed.
+    """
+    uri = params["textDocument"]["uri"]
+    analysis = await server.analyzer.analyze(uri)
+    doc = server.documents.get(uri)
+    if analysis is not None and doc is not None:
+        if analysis.version != doc.version:
+            raise RequestError(CONTENT_MODIFIED, "Document has changed")
+    return doc, analysis
+
+
+@register_method
+async def textDocument_semanticTokens_full(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    return server.semantic_tokens.full(doc, analysis)
+
+
+@register_method
+async def textDocument_semanticTokens_full_delta(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    previous_result_id = params["previousResultId"]
+    return server.semantic_tokens.full_delta(doc, analysis, previous_result_id)
+
+
+@register_method
+async def textDocument_semanticTokens_range(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    return server.semantic_tokens.range(doc, analysis, params["range"])
+
+
+def get_references(doc, analysis):
+    """Get the ReferenceIndex for an up-to-date analysis."""
+    if analysis.references is None:
+        analysis.references = build_references(
+            doc.get_line, analysis.tokens, analysis.scopes
+        )
+    return analysis.references
+
+
+def get_cursor(doc, params):
+    """Get the (line, str index) of the position in the params."""
+    position = params["position"]
+    line = min(position["line"], doc.line_count - 1)
+    index = doc.to_index(line, position["character"])
+    return line, min(index, len(doc.get_line(line)))
+
+
+def make_range(doc, line, column, length):
+    return {
+        "start": {"line": line, "character": doc.to_character(line, column)},
+        "end": {"line": line, "character": doc.to_character(line, column + length)},
     }
-    return result
+
+
+@register_method
+async def textDocument_definition(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    references = get_references(doc, analysis)
+    def_id = references.definition_at(*get_cursor(doc, params))
+    if def_id < 0:
+        return None
+    name, line, column, _ = references.definitions[def_id]
+    return {"uri": doc.uri, "range": make_range(doc, line, column, len(name))}
+
+
+@register_method
+async def textDocument_references(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    references = get_references(doc, analysis)
+    def_id = references.definition_at(*get_cursor(doc, params))
+    if def_id < 0:
+        return []
+    include_declaration = params.get("context", {}).get("includeDeclaration", True)
+    return [
+        {"uri": doc.uri, "range": make_range(doc, line, column, length)}
+        for line, column, length, is_definition in references.references_to(def_id)
+        if include_declaration or not is_definition
+    ]
+
+
+@register_method
+async def textDocument_documentHighlight(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    references = get_references(doc, analysis)
+    def_id = references.definition_at(*get_cursor(doc, params))
+    if def_id < 0:
+        return []
+    return [
+        {
+            "range": make_range(doc, line, column, length),
+            "kind": 3 if is_definition else 2,  # Write or Read
+        }
+        for line, column, length, is_definition in references.references_to(def_id)
+    ]
+
+
+def get_outline(server, doc, analysis):
+    """Get the Outline for an up-to-date analysis."""
+    if analysis.outline is None:
+        capabilities = server.client_capabilities.get("textDocument", None) or {}
+        symbol_capabilities = capabilities.get("documentSymbol", None) or {}
+        hierarchical = symbol_capabilities.get(
+            "hierarchicalDocumentSymbolSupport", False
+        )
+        analysis.outline = build_outline(doc, analysis, codec.encode, hierarchical)
+    return analysis.outline
+
+
+@register_method
+async def textDocument_documentSymbol(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    # The results are pre-encoded, so this is bytes
+    return get_outline(server, doc, analysis).symbols
+
+
+@register_method
+async def textDocument_foldingRange(server, params):
+    doc, analysis = await get_analysis(server, params)
+    if analysis is None:
+        return None
+    return get_outline(server, doc, analysis).folding_ranges
+
+
+@register_method
+async def workspace_symbol(server, params):
+    return server.workspace.symbols(params["query"], server.documents.encoding)
+
+
+@register_method
+async def workspace_didChangeWatchedFiles(server, params):
+    server.workspace.files_changed(params["changes"])
+    return None  # This is a notification
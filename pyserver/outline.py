@@ -0,0 +1,110 @@
+"""
+The outline (document symbols) and the folding ranges of a document.
+
+Both are derived from the scope tree of the analysis, in a single walk over
+it: each block (func, struct, if, etc.) can be folded, and the blocks that
+define something (func, struct, trait, impl, etc.) are the symbols of the
+outline, nested like the blocks. The results are encoded right away, and
+kept with the analysis, so they are computed once per version of the
+document, and another request for an unchanged document is a lookup.
+"""
+
+from . import lexer
+from .conv import symbolkind2int
+
+
+# The SymbolKind of the blocks that are in the outline
+_symbol_kinds = {
+    "func": symbolkind2int("Function"),
+    "proc": symbolkind2int("Function"),
+    "method": symbolkind2int("Method"),
+    "getter": symbolkind2int("Property"),
+    "setter": symbolkind2int("Property"),
+    "struct": symbolkind2int("Struct"),
+    "trait": symbolkind2int("Interface"),
+    "impl": symbolkind2int("Class"),
+}
+
+
+class Outline:
+    """The results for documentSymbol and foldingRange, as encoded JSON."""
+
+    __slots__ = ["symbols", "folding_ranges"]
+
+    def __init__(self, symbols, folding_ranges):
+        self.symbols = symbols  # list of DocumentSymbol or SymbolInformation
+        self.folding_ranges = folding_ranges  # list of FoldingRange
+
+
+def get_name_range(doc, tokens, line, name):
+    """Get the range of the first identifier with the given name on a line."""
+    start, end = tokens.line_range(line)
+    text = doc.get_line(line)
+    for i in range(start, end):
+        column, length = tokens.columns[i], tokens.lengths[i]
+        if tokens.kinds[i] != lexer.IDENTIFIER:
+            continue
+        elif text[column : column + length] == name:
+            break
+    else:
+        column, length = 0, 0
+    return {
+        "start": {"line": line, "character": doc.to_character(line, column)},
+        "end": {"line": line, "character": doc.to_character(line, column + length)},
+    }
+
+
+def build_outline(doc, analysis, encode, hierarchical=True):
+    """Build the Outline of an up-to-date analysis, encoded with the given
+    function. If not hierarchical, the symbols are a flat list of
+    SymbolInformation, with the name of the parent as containerName.
+    """
+    tokens = analysis.tokens
+    symbols = []
+    folding_ranges = []
+
+    # Walk the tree, depth first. The stack has tuples (scope, start line,
+    # the list to add its symbol to, the name of the parent symbol).
+    root = analysis.scopes.root
+    stack = [(child, child.start, symbols, None) for child in reversed(root.children)]
+    while stack:
+        scope, start, siblings, parent_name = stack.pop()
+        end = start + scope.length - 1
+        if end > start:
+            folding_ranges.append({"startLine": start, "endLine": end})
+
+        children, name = siblings, parent_name
+        kind = _symbol_kinds.get(scope.kind, None)
+        if kind is not None and scope.name:
+            name = f"impl {scope.name}" if scope.kind == "impl" else scope.name
+            # The range is from the keyword to the end of the last line
+            indentation = tokens.columns[tokens.line_range(start)[0]]
+            first_character = doc.to_character(start, indentation)
+            last_character = doc.to_character(end, len(doc.get_line(end)))
+            full_range = {
+                "start": {"line": start, "character": first_character},
+                "end": {"line": end, "character": last_character},
+            }
+            if hierarchical:
+                children = []
+                symbol = {
+                    "name": name,
+                    "kind": kind,
+                    "range": full_range,
+                    "selectionRange": get_name_range(doc, tokens, start, scope.name),
+                    "children": children,
+                }
+            else:
+                symbol = {
+                    "name": name,
+                    "kind": kind,
+                    "location": {"uri": doc.uri, "range": full_range},
+                }
+                if parent_name:
+                    symbol["containerName"] = parent_name
+            siblings.append(symbol)
+
+        for child in reversed(scope.children):
+            stack.append((child, start + child.start, children, name))
+
+    return Outline(encode(symbols), encode(folding_ranges))
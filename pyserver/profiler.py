@@ -0,0 +1,221 @@
+"""
+Profiling of the running server, on request of the client.
+
+* $/zoof/profile/start starts a sampling profiler, and $/zoof/profile/stop
+  stops it and writes the collapsed stacks to a file, in the format used by
+  flamegraph.pl, speedscope, etc.
+* $/zoof/memory/snapshot reports the top allocation sites, using
+  tracemalloc. The first call starts tracing.
+
+The sampling profiler runs in a background thread, and periodically looks
+at the stacks of all threads in the server process (the event loop thread,
+and threads like the one of the workspace index, when they are busy).
+Samples are grouped per method: a stack that goes through the handler of a
+registered method gets that method's name as its root. The worker
+processes are not sampled.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import collections
+
+from .server import register_method, method_functions
+from .errors import RequestError, INVALID_PARAMS
+from .workspace import get_cache_dir, is_in_cache_dir
+from .utils import logger
+
+
+DEFAULT_INTERVAL = 0.005  # seconds between samples
+MAX_DEPTH = 128
+
+# Threads other than the event loop thread are not sampled while they are
+# waiting in one of these functions.
+IDLE_FUNCTIONS = {"wait", "select", "poll", "_worker", "_wait_for_tstate_lock"}
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads at a regular interval."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, method_codes=None):
+        self.interval = interval
+        self._method_codes = method_codes or {}  # code object -> method name
+        self._labels = {}  # code object -> frame label
+        self.counts = collections.Counter()  # (root, stack) -> count
+        self.samples = 0
+        self.started = None
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.duration = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _label(self, code):
+        label = self._labels.get(code, None)
+        if label is None:
+            filename = os.path.basename(code.co_filename)
+            label = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+            label = self._labels[code] = label.replace(";", ":")
+        return label
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        main_id = threading.main_thread().ident
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if thread_id != main_id and frame.f_code.co_name in IDLE_FUNCTIONS:
+                continue
+            stack = []
+            method = None
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                method = method or self._method_codes.get(code, None)
+                stack.append(self._label(code))
+                frame = frame.f_back
+            if method is not None:
+                root = method
+            elif thread_id == main_id:
+                root = "[event loop]"
+            else:
+                root = f"[{thread_names.get(thread_id, thread_id)}]"
+            stack.reverse()
+            self.counts[root, tuple(stack)] += 1
+        self.samples += 1
+
+    def write_collapsed(self, filename):
+        """Write the samples as collapsed stacks ("a;b;c count" per line)."""
+        with open(filename, "w", encoding="utf-8") as f:
+            for (root, stack), count in self.counts.most_common():
+                f.write(";".join((root,) + stack) + f" {count}\n")
+
+    def summary(self, top=10):
+        """Get a dict with the number of samples per root (method or thread)."""
+        per_root = collections.Counter()
+        for (root, _), count in self.counts.items():
+            per_root[root] += count
+        return {
+            "samples": self.samples,
+            "duration": round(self.duration, 3),
+            "top": [[root, count] for root, count in per_root.most_common(top)],
+        }
+
+
+def get_method_codes():
+    """Get a dict that maps the code objects of the handlers to method names."""
+    codes = {}
+    for name, func in method_functions.items():
+        code = getattr(func, "__code__", None)
+        if code is not None:
+            codes[code] = name
+    return codes
+
+
+_profiler = None  # the running SamplingProfiler
+_last_snapshot = None  # the last tracemalloc snapshot
+
+
+@register_method(name="$/zoof/profile/start")
+async def profile_start(server, params):
+    """Start the sampling profiler. Params: {"interval": seconds}."""
+    global _profiler
+    params = params or {}
+    if _profiler is not None:
+        return {"started": False, "message": "The profiler is already running"}
+    interval = float(params.get("interval", DEFAULT_INTERVAL))
+    _profiler = SamplingProfiler(interval, get_method_codes())
+    _profiler.start()
+    logger.info(f"Profiler started (interval {1000 * interval:0.1f} ms)")
+    return {"started": True}
+
+
+@register_method(name="$/zoof/profile/stop")
+async def profile_stop(server, params):
+    """Stop the sampling profiler, and write the collapsed stacks to a file.
+    Params: {"filename": path}. Returns the filename and a summary. In daemon
+    mode, the file must be in the cache directory of the server.
+    """
+    global _profiler
+    params = params or {}
+    filename = params.get("filename", None)
+    if filename and server.daemon is not None and not is_in_cache_dir(filename):
+        raise RequestError(
+            INVALID_PARAMS, f"The profile must be written in {get_cache_dir()}"
+        )
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    profiler.stop()
+    if not filename:
+        name = f"zoof-lsp-profile-{os.getpid()}-{int(time.time())}.collapsed"
+        filename = os.path.join(tempfile.gettempdir(), name)
+    profiler.write_collapsed(filename)
+    logger.info(f"Profiler stopped, wrote {profiler.samples} samples to {filename}")
+    return {"filename": filename, **profiler.summary()}
+
+
+@register_method(name="$/zoof/memory/snapshot")
+async def memory_snapshot(server, params):
+    """Report the top allocation sites. The first call starts tracing.
+    Params: {"top": count, "frames": frames per trace, "stop": bool}.
+    """
+    import tracemalloc
+
+    global _last_snapshot
+    params = params or {}
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(int(params.get("frames", 1)))
+        _last_snapshot = None
+        return {"tracing": True, "top": [], "message": "Started tracing"}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ]
+    )
+    top = int(params.get("top", 20))
+    if _last_snapshot is None:
+        stats = snapshot.statistics("lineno")
+    else:
+        stats = snapshot.compare_to(_last_snapshot, "lineno")
+    result = []
+    for stat in stats[:top]:
+        frame = stat.traceback[0]
+        d = {
+            "site": f"{frame.filename}:{frame.lineno}",
+            "size": stat.size,
+            "count": stat.count,
+        }
+        if _last_snapshot is not None:
+            d["size_diff"] = stat.size_diff
+            d["count_diff"] = stat.count_diff
+        result.append(d)
+    current, peak = tracemalloc.get_traced_memory()
+    _last_snapshot = snapshot
+    if params.get("stop", False):
+        tracemalloc.stop()
+        _last_snapshot = None
+    return {
+        "tracing": tracemalloc.is_tracing(),
+        "current": current,
+        "peak": peak,
+        "top": result,
+    }
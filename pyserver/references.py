@@ -0,0 +1,145 @@
+"""
+The references in a document, indexed by position.
+
+Each identifier in a document is resolved (via the scopes) to the
+definition that it refers to. The references are stored in parallel arrays,
+sorted by position, so that the reference under the cursor is found with a
+binary search. A reverse index, the reference indices sorted by definition,
+is built when first needed, so that finding all references does not need a
+scan.
+
+A position is packed in a single integer, (line << COLUMN_BITS) | column,
+so that positions compare in document order.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from . import lexer
+
+
+COLUMN_BITS = 20
+MAX_COLUMN = (1 << COLUMN_BITS) - 1
+
+
+def pack_position(line, column):
+    return (line << COLUMN_BITS) | min(column, MAX_COLUMN)
+
+
+def unpack_position(key):
+    return key >> COLUMN_BITS, key & MAX_COLUMN
+
+
+class ReferenceIndex:
+    """The resolved references of a document.
+
+    Positions are (line, str index) tuples. The definitions are tuples
+    (name, line, column, kind), and are referred to by their index in
+    self.definitions.
+    """
+
+    __slots__ = ["definitions", "_keys", "_lengths", "_targets", "_by_target"]
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self._keys = array("Q")  # sorted packed start positions
+        self._lengths = array("I")
+        self._targets = array("I")  # definition ids
+        self._by_target = None  # (reference indices, definition ids), sorted
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, line, column, length, def_id):
+        """Add a reference. References must be added in document order."""
+        self._keys.append(pack_position(line, column))
+        self._lengths.append(length)
+        self._targets.append(def_id)
+        self._by_target = None
+
+    def get(self, i):
+        """Get (line, column, length, definition id) of reference i."""
+        line, column = unpack_position(self._keys[i])
+        return line, column, self._lengths[i], self._targets[i]
+
+    def find(self, line, column):
+        """Get the index of the reference at the given position, or -1.
+
+        A position at the end of a reference (i.e. just after the last
+        character) also counts, because that is where the cursor is after
+        typing a name.
+        """
+        key = pack_position(line, column)
+        i = bisect_right(self._keys, key) - 1
+        if i >= 0 and key <= self._keys[i] + self._lengths[i]:
+            return i
+        return -1
+
+    def definition_at(self, line, column):
+        """Get the id of the definition referred to at the position, or -1."""
+        i = self.find(line, column)
+        return self._targets[i] if i >= 0 else -1
+
+    def references_to(self, def_id):
+        """Get a list of (line, column, length, is_definition) for all the
+        references to the given definition.
+        """
+        _, def_line, def_column, _ = self.definitions[def_id]
+        def_key = pack_position(def_line, def_column)
+        if self._by_target is None:
+            # A stable sort, so the references of a definition stay in order
+            targets = self._targets
+            order = sorted(range(len(targets)), key=targets.__getitem__)
+            self._by_target = array("I", order), array("I", sorted(targets))
+        order, sorted_targets = self._by_target
+        i0 = bisect_left(sorted_targets, def_id)
+        i1 = bisect_right(sorted_targets, def_id, i0)
+        result = []
+        for i in order[i0:i1]:
+            key = self._keys[i]
+            line, column = unpack_position(key)
+            result.append((line, column, self._lengths[i], key == def_key))
+        return result
+
+
+def build_references(get_line, tokens, scopes):
+    """Build a ReferenceIndex from the lines, TokenStream and ScopeIndex of
+    a document. Identifiers that follow a dot (attributes) are not resolved.
+    """
+    # Number the definitions, and make a lookup table per scope. Only the
+    # first definition of a name in a scope counts.
+    definitions = []
+    tables = {}  # id(scope) -> {name: definition id}
+    for scope, base, _ in scopes.iter_scopes():
+        table = {}
+        for name, rel_line, column, kind in scope.definitions:
+            if name not in table:
+                table[name] = len(definitions)
+                definitions.append((name, base + rel_line, column, kind))
+        tables[id(scope)] = table
+
+    index = ReferenceIndex(definitions)
+    columns, lengths, kinds = tokens.columns, tokens.lengths, tokens.kinds
+    line_counts = tokens.line_counts
+    end = 0  # index of the first token of the next line
+    for line in range(tokens.line_count):
+        start, end = end, end + line_counts[line]
+        if lexer.IDENTIFIER not in kinds[start:end]:
+            continue
+        text = get_line(line)
+        visible = None  # tables from inner to outer scope, computed lazily
+        after_dot = False
+        for j in range(start, end):
+            column, length, kind = columns[j], lengths[j], kinds[j]
+            if kind == lexer.IDENTIFIER and not after_dot:
+                if visible is None:
+                    visible = [tables[id(s)] for s, _ in scopes.scopes_at(line)]
+                    visible.reverse()
+                name = text[column : column + length]
+                for table in visible:
+                    def_id = table.get(name, -1)
+                    if def_id >= 0:
+                        index.add(line, column, length, def_id)
+                        break
+            after_dot = kind == lexer.PUNCTUATION and text[column] == "."
+    return index
@@ -0,0 +1,202 @@
+"""
+Scheduling of incoming messages onto the event loop.
+
+Messages are put in one of three lanes:
+
+* Document-sync notifications are applied in the order that they arrive,
+  per document.
+* Heavy analysis requests run one at a time per method and document. The
+  waiting requests with the same params, for the same version of the
+  document, are coalesced: they share the result of one computation. The
+  waiting requests for an older version are answered with ContentModified.
+* All other messages (notably latency-sensitive requests like completion)
+  run right away. They only wait for pending document-sync notifications
+  of the same document, so they see the latest text.
+
+Requests in flight are tracked by id, so they can be cancelled. The version
+of each document is tracked as document-sync notifications arrive, so that
+handlers can detect that the document changed while they were running.
+"""
+
+import time
+import asyncio
+
+from .errors import CONTENT_MODIFIED, REQUEST_CANCELLED
+
+
+# Notifications that change the document state.
+DOCUMENT_SYNC = {
+    "textDocument/didOpen",
+    "textDocument/didChange",
+    "textDocument/didSave",
+    "textDocument/didClose",
+}
+
+# Expensive requests that analyse a whole document.
+HEAVY = {
+    "textDocument/semanticTokens/full",
+    "textDocument/semanticTokens/full/delta",
+    "textDocument/semanticTokens/range",
+    "textDocument/documentSymbol",
+    "textDocument/foldingRange",
+}
+
+
+def get_uri(d):
+    """Get the uri of the document that a message applies to, or None."""
+    params = d.get("params", None)
+    if isinstance(params, dict):
+        text_document = params.get("textDocument", None)
+        if isinstance(text_document, dict):
+            return text_document.get("uri", None)
+    return None
+
+
+class Scheduler:
+    """Puts incoming messages in the right lane, and feeds them to the server."""
+
+    def __init__(self, server):
+        self._server = server
+        self._sync_tails = {}  # uri -> last document-sync task
+        # (method, uri) -> list of [version, params, requests], the requests
+        # being a list of (message, queued_at) that share the response
+        self._heavy_pending = {}
+        self._heavy_running = {}  # (method, uri) -> the group being computed
+        self._heavy_workers = {}  # (method, uri) -> task
+        self._in_flight = {}  # request id -> task
+        self._versions = {}  # uri -> version of the last received change
+
+    def get_version(self, uri):
+        """Get the version of the most recently received change of a document.
+
+        This can be ahead of the version of the document store, when changes
+        are still being applied.
+        """
+        return self._versions.get(uri, None)
+
+    def submit(self, d):
+        """Schedule a message. Must be called from the event loop."""
+        queued_at = time.perf_counter()
+        loop = self._server._loop
+        method = d.get("method", "")
+        uri = get_uri(d)
+        id = d.get("id", None)
+
+        if method in DOCUMENT_SYNC:
+            if method == "textDocument/didClose":
+                self._versions.pop(uri, None)
+            elif method != "textDocument/didSave":
+                # didSave has no version, and does not change the text
+                version = d["params"]["textDocument"].get("version", None)
+                self._versions[uri] = version
+            previous = self._sync_tails.get(uri, None)
+            task = loop.create_task(self._run(d, queued_at, previous))
+            self._sync_tails[uri] = task
+            task.add_done_callback(lambda t: self._sync_done(uri, t))
+        elif method in HEAVY and uri:
+            key = method, uri
+            version = self._versions.get(uri, None)
+            params = d.get("params", None)
+            groups = self._heavy_pending.setdefault(key, [])
+            for group in groups:
+                if group[0] == version and group[1] == params:
+                    group[2].append((d, queued_at))
+                    break
+            else:
+                groups.append([version, params, [(d, queued_at)]])
+            for group in [group for group in groups if group[0] != version]:
+                groups.remove(group)
+                for old, _ in group[2]:
+                    self._server.respond_error(
+                        old, CONTENT_MODIFIED, "Document has changed"
+                    )
+            if key not in self._heavy_workers:
+                task = loop.create_task(self._heavy_worker(key))
+                self._heavy_workers[key] = task
+        else:
+            pending_sync = self._sync_tails.get(uri, None) if uri else None
+            task = loop.create_task(self._run(d, queued_at, pending_sync))
+            if id is not None:
+                self._in_flight[id] = task
+                task.add_done_callback(lambda t: self._request_done(d, t))
+
+    def cancel(self, id):
+        """Cancel the request with the given id, if it is still pending."""
+        for groups in self._heavy_pending.values():
+            for group in groups:
+                for request in group[2]:
+                    if request[0].get("id", None) == id:
+                        group[2].remove(request)
+                        if not group[2]:
+                            groups.remove(group)
+                        self._respond_cancelled(request[0])
+                        return
+        for group in self._heavy_running.values():
+            requests = group[2]
+            for request in requests:
+                if request[0].get("id", None) == id and len(requests) > 1:
+                    # Others share the computation, so only drop this one
+                    requests.remove(request)
+                    self.untrack(id)
+                    self._respond_cancelled(request[0])
+                    return
+        task = self._in_flight.pop(id, None)
+        if task is not None:
+            task.cancel()
+
+    def cancel_all(self):
+        """Cancel all pending work, e.g. when the client has gone."""
+        self._heavy_pending.clear()
+        tasks = [*self._in_flight.values(), *self._heavy_workers.values()]
+        tasks.extend(self._sync_tails.values())
+        self._in_flight.clear()
+        for task in tasks:
+            task.cancel()
+
+    def untrack(self, id):
+        """Mark the request as done. It can no longer be cancelled."""
+        if id is not None:
+            self._in_flight.pop(id, None)
+
+    def _request_done(self, d, task):
+        # A task that is cancelled before handle_request() could catch it
+        if task.cancelled():
+            self.untrack(d["id"])
+            self._respond_cancelled(d)
+
+    def _respond_cancelled(self, d):
+        self._server.respond_error(d, REQUEST_CANCELLED, "Request cancelled")
+
+    def _sync_done(self, uri, task):
+        if self._sync_tails.get(uri, None) is task:
+            self._sync_tails.pop(uri)
+
+    async def _run(self, d, queued_at, wait_for=None, requests=None):
+        if wait_for is not None and not wait_for.done():
+            await asyncio.wait([wait_for])
+        await self._server.handle_request(d, queued_at, requests)
+
+    async def _heavy_worker(self, key):
+        try:
+            while self._heavy_pending.get(key, None):
+                group = self._heavy_pending[key].pop(0)
+                requests = group[2]
+                d, queued_at = requests[0]
+                pending_sync = self._sync_tails.get(key[1], None)
+                for request, _ in requests:
+                    if request.get("id", None) is not None:
+                        self._in_flight[request["id"]] = asyncio.current_task()
+                self._heavy_running[key] = group
+                try:
+                    await self._run(d, queued_at, pending_sync, requests)
+                except asyncio.CancelledError:
+                    # The request was cancelled (before it started), not the worker
+                    for request, _ in requests:
+                        self.untrack(request.get("id", None))
+                        self._respond_cancelled(request)
+                finally:
+                    self._heavy_running.pop(key, None)
+        finally:
+            self._heavy_workers.pop(key, None)
+            if not self._heavy_pending.get(key, None):
+                self._heavy_pending.pop(key, None)
@@ -0,0 +1,381 @@
+"""
+Scopes and the definitions in them, derived from the indentation structure.
+
+A structural pass over the token stream finds the blocks (func, struct, if,
+etc.) from the indentation of the lines. Each block is a scope that spans a
+range of lines. The scopes form a tree; the children of a scope are sorted
+and do not overlap, so the scopes that contain a line are found with a
+bisect at each level, in O(depth * log n).
+
+Lines of children (and of definitions) are stored relative to the start of
+their parent scope, so that when lines are inserted or deleted, only the
+scopes along the edit need to be updated. The later siblings of those scopes
+are shifted lazily: a scope keeps a pending shift for its children from some
+index on, which absorbs the next edit at the same place, e.g. while typing.
+The definitions of the scopes along the edit are updated when the tree is
+walked from the root.
+"""
+
+from sys import intern
+from bisect import bisect_left, bisect_right
+
+from . import lexer
+
+
+# Keywords that start a block
+BLOCK_KEYWORDS = {
+    "func",
+    "proc",
+    "method",
+    "getter",
+    "setter",
+    "struct",
+    "trait",
+    "impl",
+    "if",
+    "elif",
+    "elseif",
+    "else",
+    "for",
+    "while",
+}
+
+# Keywords that start a block and define a name in the parent scope
+DEFINITION_KEYWORDS = {"func", "proc", "method", "getter", "setter", "struct", "trait"}
+
+# Keywords that may precede a block keyword
+MODIFIER_KEYWORDS = {"abstract"}
+
+
+class Scope:
+    """A scope, spanning a range of lines."""
+
+    __slots__ = [
+        "kind",
+        "name",
+        "start",
+        "length",
+        "definitions",
+        "children",
+        "_starts",
+        "_names",
+    ]
+
+    def __init__(self, kind, name, start, length=1):
+        self.kind = kind  # the keyword that opened the block, or "module"
+        self.name = name  # name of the defined thing, or None
+        self.start = start  # relative to the parent's start
+        self.length = length  # number of lines
+        self.definitions = []  # (name, line, column, kind), line is relative
+        self.children = []  # replaced with () when closed without children
+        self._starts = None  # cache of child starts, for bisect
+        self._names = None  # cache of definitions sorted by name
+
+    def __repr__(self):
+        name = self.name or ""
+        return f"<Scope {self.kind} {name} +{self.start} ({self.length})>"
+
+    def __getstate__(self):
+        return (
+            self.kind,
+            self.name,
+            self.start,
+            self.length,
+            self.definitions,
+            self.children,
+        )
+
+    def __setstate__(self, state):
+        # Scopes come from the workers pickled. Intern the names again, so
+        # that they are shared between scopes and documents.
+        kind, name, self.start, self.length, definitions, self.children = state
+        self.kind = intern(kind)
+        self.name = name and intern(name)
+        self.definitions = [
+            (intern(name), line, column, intern(kind))
+            for name, line, column, kind in definitions
+        ] or ()
+        self._starts = None
+        self._names = None
+
+    def _child_starts(self):
+        if self._starts is None:
+            self._starts = [child.start for child in self.children]
+        return self._starts
+
+    def _sorted_names(self):
+        # Edits only move definitions, so this is valid for the life of the
+        # scope. Returns the lowercase names, and (name, kind) in that order.
+        if self._names is None:
+            pairs = sorted(
+                (name.lower(), (name, kind)) for name, _, _, kind in self.definitions
+            )
+            self._names = [key for key, _ in pairs], [item for _, item in pairs]
+        return self._names
+
+    def names_with_prefix(self, prefix):
+        """Generate (name, kind) for the definitions in this scope whose name
+        starts with the (lowercase) prefix, in order of name.
+        """
+        if not self.definitions:
+            return
+        keys, items = self._sorted_names()
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            yield items[i]
+
+
+def _bisect_starts(bisect, starts, line, index, shift):
+    # Bisect the starts of children, of which those from index on are
+    # shifted. Both parts are sorted, and the shifted part comes after.
+    if index < len(starts) and (
+        line >= starts[index] + shift
+        if bisect is bisect_right
+        else line > starts[index] + shift
+    ):
+        return bisect(starts, line - shift, index)
+    return bisect(starts, line, 0, index)
+
+
+class ScopeIndex:
+    """The tree of scopes of a document."""
+
+    __slots__ = ["_root", "_pending"]
+
+    def __init__(self, root):
+        self._root = root
+        # Edits not applied yet: scope -> [index, shift, definition edits],
+        # the children from index on are to be moved by shift lines.
+        self._pending = {}
+
+    @property
+    def root(self):
+        """The root scope, with all pending edits applied."""
+        if self._pending:
+            self._apply_pending()
+        return self._root
+
+    def _apply_pending(self):
+        for scope, (index, shift, definition_edits) in self._pending.items():
+            if shift:
+                starts = scope._child_starts()
+                for i in range(index, len(scope.children)):
+                    scope.children[i].start += shift
+                    starts[i] += shift
+            for base, new_base, map_line in definition_edits:
+                scope.definitions = [
+                    (name, map_line(base + rel_line) - new_base, column, kind)
+                    for name, rel_line, column, kind in scope.definitions
+                ]
+        self._pending.clear()
+
+    def _child_at(self, scope, line):
+        # Get (child, relative start) for the child scope that contains the
+        # (relative) line, or (None, 0).
+        if not scope.children:
+            return None, 0
+        pending = self._pending.get(scope, None)
+        index, shift = pending[:2] if pending else (len(scope.children), 0)
+        i = _bisect_starts(bisect_right, scope._child_starts(), line, index, shift)
+        if i > 0:
+            child = scope.children[i - 1]
+            start = child.start + shift if i > index else child.start
+            if line < start + child.length:
+                return child, start
+        return None, 0
+
+    def scopes_at(self, line):
+        """Get the list of (scope, absolute start line) containing the line,
+        from outer to inner.
+        """
+        scope, base = self._root, 0
+        path = [(scope, base)]
+        while True:
+            child, start = self._child_at(scope, line - base)
+            if child is None:
+                return path
+            scope, base = child, base + start
+            path.append((scope, base))
+
+    def names_at(self, line, prefix=""):
+        """Generate (name, kind) for the definitions that are visible at the
+        given line, and whose name starts with the prefix (ignoring case),
+        from inner to outer scope. A name can occur more than once.
+        """
+        prefix = prefix.lower()
+        for scope, _ in reversed(self.scopes_at(line)):
+            yield from scope.names_with_prefix(prefix)
+
+    def iter_scopes(self):
+        """Generate (scope, absolute start line, depth) in document order."""
+        stack = [(self.root, 0, 0)]
+        while stack:
+            scope, base, depth = stack.pop()
+            yield scope, base, depth
+            for child in reversed(scope.children):
+                stack.append((child, base + child.start, depth + 1))
+
+    def apply_edit(self, line, removed, added):
+        """Update the line numbers for lines [line, line + removed) being
+        replaced by added lines. Scopes inside the removed lines shrink or
+        disappear; the structure of the new lines is not known until the
+        scopes are rebuilt.
+        """
+        end = line + removed
+        delta = added - removed
+
+        def map_line(p):
+            if p < line:
+                return p
+            elif p >= end:
+                return p + delta
+            return line + min(p - line, added)
+
+        root = self._root
+        root.length = max(1, map_line(root.length))
+        self._edit_scope(root, 0, 0, map_line, line, end, delta)
+
+    def _edit_scope(self, scope, base, new_base, map_line, line, end, delta):
+        # Edit a scope that overlaps with the edit, that moves from base to
+        # new_base. Its definitions are mapped when the root is next used.
+        pending = self._pending.get(scope, None)
+        if pending is None:
+            pending = self._pending[scope] = [len(scope.children), 0, []]
+        pending[2].append((base, new_base, map_line))
+        children = scope.children
+        if not children:
+            return
+
+        # The children in [i0, i1) overlap with the edit
+        index, shift = pending[0], pending[1]
+        starts = scope._child_starts()
+        i0 = _bisect_starts(bisect_right, starts, line - base, index, shift)
+        if i0 > 0:
+            child = children[i0 - 1]
+            start = child.start + shift if i0 > index else child.start
+            if line - base < start + child.length:
+                i0 -= 1
+        i1 = max(i0, _bisect_starts(bisect_left, starts, end - base, index, shift))
+
+        # Move the pending shift to i1, adding the shift of this edit. Only
+        # the children between the old and the new index are updated.
+        for i in range(index, i1):
+            children[i].start += shift
+            starts[i] += shift
+        for i in range(i1, index):
+            children[i].start -= shift
+            starts[i] -= shift
+        shift += delta + base - new_base
+
+        kept = []
+        for child in children[i0:i1]:
+            child_start = base + child.start
+            child_end = child_start + child.length
+            new_start = map_line(child_start)
+            new_end = map_line(child_end)
+            if new_end <= new_start:
+                continue  # removed
+            self._edit_scope(child, child_start, new_start, map_line, line, end, delta)
+            child.start = new_start - new_base
+            child.length = new_end - new_start
+            kept.append(child)
+        children[i0:i1] = kept
+        starts[i0:i1] = [child.start for child in kept]
+        pending[0], pending[1] = i0 + len(kept), shift
+
+
+def build_scopes(get_line, tokens):
+    """Build a ScopeIndex from the lines and the TokenStream of a document.
+
+    The blocks are found from the indentation: a line that starts with a
+    block keyword opens a scope, that ends before the next line that is not
+    indented more. Lines without code (whitespace or comment) do not end a
+    scope, and are part of it if they are indented more than its first line,
+    so that e.g. a new indented line at the end of a function is in the
+    function.
+    """
+    line_count = tokens.line_count
+    root = Scope("module", None, 0, line_count)
+    stack = [[root, -1, 0, line_count]]  # [scope, indentation, start, end]
+
+    def close():
+        scope, _, start, end = stack.pop()
+        scope.length = max(1, end - start)
+        # Most scopes are leaves, or define nothing, so share an empty tuple
+        scope.children = scope.children or ()
+        scope.definitions = scope.definitions or ()
+        stack[-1][3] = max(stack[-1][3], end)
+
+    columns, lengths, all_kinds = tokens.columns, tokens.lengths, tokens.kinds
+    line_counts = tokens.line_counts
+    end = 0  # index of the first token of the next line
+    for i in range(line_count):
+        start, end = end, end + line_counts[i]
+        kinds = all_kinds[start:end]
+        text = get_line(i)
+        if kinds.count(lexer.COMMENT) == len(kinds):
+            # No code on this line
+            indentation = columns[start] if kinds else len(text)
+            for info in reversed(stack):
+                if info[1] < indentation:
+                    info[3] = i + 1
+                    break
+            continue
+        indentation = columns[start]
+
+        while stack[-1][1] >= indentation:
+            close()
+        stack[-1][3] = i + 1
+
+        parent, _, parent_start, _ = stack[-1]
+        line_columns = columns[start:end]
+        words = [
+            text[column : column + length]
+            for column, length in zip(line_columns, lengths[start:end])
+        ]
+
+        first = 0
+        while first < len(words) - 1 and words[first] in MODIFIER_KEYWORDS:
+            first += 1
+        keyword = intern(words[first]) if kinds[first] == lexer.KEYWORD else None
+
+        if keyword in BLOCK_KEYWORDS:
+            name = None
+            if keyword in DEFINITION_KEYWORDS or keyword == "impl":
+                if first + 1 < len(words) and kinds[first + 1] == lexer.IDENTIFIER:
+                    name = intern(words[first + 1])
+                    if keyword != "impl":
+                        column = line_columns[first + 1]
+                        parent.definitions.append(
+                            (name, i - parent_start, column, keyword)
+                        )
+            scope = Scope(keyword, name, i - parent_start)
+            parent.children.append(scope)
+            stack.append([scope, indentation, i, i + 1])
+            # Parameters, and loop variables, are defined in the new scope
+            if keyword in DEFINITION_KEYWORDS and name:
+                kind = "parameter"
+                candidates = range(first + 2, len(words))
+            elif keyword == "for":
+                kind = "variable"
+                candidates = range(first + 1, len(words))
+            else:
+                candidates = ()
+            for j in candidates:
+                if keyword == "for" and words[j] == "in":
+                    break
+                if kinds[j] == lexer.IDENTIFIER:
+                    column = line_columns[j]
+                    scope.definitions.append((intern(words[j]), 0, column, kind))
+        elif len(words) > 1 and kinds[0] == lexer.IDENTIFIER and words[1] == "=":
+            # An assignment defines a variable, unless it already exists
+            name = intern(words[0])
+            if not any(d[0] == name for d in parent.definitions):
+                column = line_columns[0]
+                definition = name, i - parent_start, column, "variable"
+                parent.definitions.append(definition)
+
+    while len(stack) > 1:
+        close()
+    return ScopeIndex(root)
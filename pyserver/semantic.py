@@ -0,0 +1,184 @@
+"""
+Semantic tokens, for highlighting by the language server.
+
+The tokens of the analysis are encoded in the packed format of the LSP spec:
+five integers per token (delta line, delta start, length, type, modifiers).
+The last result per document is cached, so that delta requests can send
+only the part that changed.
+"""
+
+from array import array
+
+from . import lexer
+
+
+TOKEN_TYPES = [
+    "keyword",
+    "operator",
+    "enumMember",
+    "number",
+    "string",
+    "comment",
+    "variable",
+    "function",
+    "method",
+    "struct",
+    "interface",
+]
+TOKEN_MODIFIERS = ["declaration"]
+
+LEGEND = {"tokenTypes": TOKEN_TYPES, "tokenModifiers": TOKEN_MODIFIERS}
+
+_type_index = {name: i for i, name in enumerate(TOKEN_TYPES)}
+
+# Map lexer token kinds to token types. Kinds that map to None are not sent.
+_kind_to_type = {
+    lexer.KEYWORD: _type_index["keyword"],
+    lexer.OPERATOR: _type_index["operator"],
+    lexer.CONSTANT: _type_index["enumMember"],
+    lexer.NUMBER: _type_index["number"],
+    lexer.STRING: _type_index["string"],
+    lexer.COMMENT: _type_index["comment"],
+    lexer.IDENTIFIER: _type_index["variable"],
+    lexer.PUNCTUATION: None,
+    lexer.ERROR: None,
+}
+
+# The type of an identifier that follows one of these keywords
+_declaration_types = {
+    "func": _type_index["function"],
+    "proc": _type_index["function"],
+    "method": _type_index["method"],
+    "getter": _type_index["method"],
+    "setter": _type_index["method"],
+    "struct": _type_index["struct"],
+    "trait": _type_index["interface"],
+}
+DECLARATION = 1  # bit for the "declaration" modifier
+
+
+def encode(doc, tokens, first_line=0, last_line=None):
+    """Encode the tokens of the given document, optionally for a line range.
+
+    The tokens are a TokenStream for the current version of the document.
+    """
+    data = array("I")
+    if last_line is None:
+        last_line = doc.line_count - 1
+    prev_line = prev_start = 0
+    cur_line = -1
+    text = ""
+    units = None
+    declaration_type = None
+
+    for line, column, length, kind in tokens.iter_tokens(first_line, last_line):
+        if line != cur_line:
+            cur_line = line
+            text = doc.get_line(line)
+            units = doc.get_units(line)
+
+        token_type = _kind_to_type[kind]
+        modifiers = 0
+        if kind == lexer.KEYWORD:
+            declaration_type = _declaration_types.get(text[column : column + length])
+        elif kind == lexer.IDENTIFIER and declaration_type is not None:
+            token_type = declaration_type
+            modifiers = DECLARATION
+            declaration_type = None
+        else:
+            declaration_type = None
+        if token_type is None:
+            continue
+
+        if units is not None:
+            end = units[column + length]
+            column = units[column]
+            length = end - column
+
+        if line != prev_line:
+            prev_start = 0
+        data.extend((line - prev_line, column - prev_start, length))
+        data.extend((token_type, modifiers))
+        prev_line, prev_start = line, column
+
+    return data
+
+
+def diff(old, new):
+    """Get the edits (list of dicts) to turn the old data into the new data."""
+    # Compare bytes, so that the comparisons run at C speed
+    itemsize = old.itemsize
+    old_bytes, new_bytes = old.tobytes(), new.tobytes()
+    n = min(len(old), len(new))
+
+    # Common prefix, found with a binary search
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old_bytes[: mid * itemsize] == new_bytes[: mid * itemsize]:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+
+    # Common suffix (not overlapping the prefix)
+    lo, hi = 0, n - prefix
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        k = mid * itemsize
+        if old_bytes[len(old_bytes) - k :] == new_bytes[len(new_bytes) - k :]:
+            lo = mid
+        else:
+            hi = mid - 1
+    suffix = lo
+
+    delete_count = len(old) - prefix - suffix
+    insert = new[prefix : len(new) - suffix]
+    if not delete_count and not insert:
+        return []
+    return [{"start": prefix, "deleteCount": delete_count, "data": insert.tolist()}]
+
+
+class SemanticTokensCache:
+    """Keeps the last semantic tokens result per document."""
+
+    def __init__(self):
+        self._results = {}  # uri -> (result_id, version, data)
+        self._count = 0
+
+    def close(self, uri):
+        self._results.pop(uri, None)
+
+    def _encode(self, doc, analysis):
+        """Get (result_id, data), reusing the last result if it's up to date."""
+        previous = self._results.get(doc.uri, None)
+        if previous is not None and previous[1] == analysis.version:
+            return previous[0], previous[2]
+        data = encode(doc, analysis.tokens)
+        self._count += 1
+        result_id = f"{analysis.version}-{self._count}"
+        self._results[doc.uri] = result_id, analysis.version, data
+        return result_id, data
+
+    def full(self, doc, analysis):
+        """Get a SemanticTokens result for the whole document."""
+        result_id, data = self._encode(doc, analysis)
+        return {"resultId": result_id, "data": data.tolist()}
+
+    def full_delta(self, doc, analysis, previous_result_id):
+        """Get a SemanticTokensDelta result, or a full result if we can't."""
+        previous = self._results.get(doc.uri, None)
+        if previous is None or previous[0] != previous_result_id:
+            return self.full(doc, analysis)
+        result_id, data = self._encode(doc, analysis)
+        edits = diff(previous[2], data)
+        return {"resultId": result_id, "edits": edits}
+
+    def range(self, doc, analysis, range):
+        """Get a SemanticTokens result for a range of lines."""
+        first_line = max(0, range["start"]["line"])
+        last_line = min(range["end"]["line"], doc.line_count - 1)
+        if first_line > last_line:
+            return {"data": []}
+        data = encode(doc, analysis.tokens, first_line, last_line)
+        return {"data": data.tolist()}
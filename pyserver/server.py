@@ -1,156 +1,455 @@
+import os
 import sys
 import json
+import time
 import asyncio
-import threading
+from importlib import import_module
 
 from .utils import logger, print
+from .errors import RequestError, INTERNAL_ERROR, METHOD_NOT_FOUND, INVALID_REQUEST
+from .errors import REQUEST_CANCELLED, CONTENT_MODIFIED
+from .stats import Stats
+from .scheduler import Scheduler, DOCUMENT_SYNC, get_uri
+from .transport import open_stdio, serve_tcp
+from .documents import DocumentStore, negotiate_encoding
+from .analysis import Analyzer
+from .workspace import WorkspaceIndex
+from .semantic import SemanticTokensCache, LEGEND
+from .diagnostics import DiagnosticsPublisher
+from .startup import StartupTimer
 
 
 __version__ = "0.0.1"
 
 
-# == The io thread and server
+# == JSON codecs
 
 
-class IOThread(threading.Thread):
-    """To read from stdin and feed the result into the main threads event loop."""
+class JsonCodec:
+    """Encodes and decodes JSON messages (bytes), using the stdlib."""
 
-    def __init__(self, loop, dispatch_func):
-        super().__init__()
-        self._loop = loop  # in main thread
-        self._dispatch_func = dispatch_func
-        self.daemon = True
+    name = "json"
 
-    def run(self):
-        logger.info("io thread started")
-        content_length = 0
-        rfile = sys.stdin.buffer  # binary file io
-        try:
-            while True:
-                line = rfile.readline().decode()
-                if not line:
-                    break  # stdin is closed
-                elif not line.strip():
-                    # Header is done, we can read the content
-                    if content_length > 0:
-                        self.send_content(rfile.read(content_length).decode())
-                        content_length = 0
-                    else:
-                        logger.error(f"Got a message with Content-Length zero")
-                elif line.startswith("Content-Length:"):
-                    try:
-                        content_length = int(line.split(":")[-1].strip())
-                    except Exception:
-                        logger.error(f"Could not parse Content-Length: {line.strip()}")
-                elif line.startswith("Content-Type:"):
-                    if line.strip() != "application/vscode-jsonrpc; charset=utf-8":
-                        logger.warning(f"Unexpected Content-Type: {line.strip()}")
-                else:
-                    logger.warning(f"Ignoring incoming line: {line.strip()}")
-        except Exception as err:
-            logger.error(f"io thread errored: {str(err)}")
-        else:
-            logger.info("io thread stopped")
+    def __init__(self):
+        self._encode = json.JSONEncoder(separators=(",", ":")).encode
+
+    def decode(self, data):
+        return json.loads(data)  # json accepts utf-8 bytes
 
-    def send_content(self, content):
-        """Method, called from this thread, to convert the content to a dict and send it to the main thread."""
+    def encode(self, ob):
+        return self._encode(ob).encode()
+
+
+class OrjsonCodec:
+    """Encodes and decodes JSON messages (bytes), using orjson, which works
+    on bytes directly, and is a lot faster.
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self.decode = orjson.loads
+        self.encode = orjson.dumps
+
+
+def get_codec(name=None):
+    """Get the codec with the given name, or the fastest available codec."""
+    if name in (None, "", "orjson"):
         try:
-            d = json.loads(content)
-        except Exception:
-            logger.error("Could not convert content to JSON")
-        else:
-            self._loop.call_soon_threadsafe(self._dispatch_func, d)
+            return OrjsonCodec()
+        except ImportError:
+            if name == "orjson":
+                logger.warning("orjson is not available, using json")
+    return JsonCodec()
 
 
-class LanguageServer:
-    """The language server object."""
+codec = get_codec(os.getenv("ZOOF_LSP_JSON", None))
+
+
+def encode_response(id, result=None, error=None):
+    """Encode a response message. The result may be bytes that contain
+    pre-encoded JSON, which is spliced into the message as-is.
+    """
+    if error is not None:
+        return codec.encode({"jsonrpc": "2.0", "id": id, "error": error})
+    elif isinstance(result, (bytes, bytearray)):
+        head = b'{"jsonrpc":"2.0","id":' + codec.encode(id) + b',"result":'
+        return b"".join((head, result, b"}"))
+    return codec.encode({"jsonrpc": "2.0", "id": id, "result": result})
+
+
+class Batch:
+    """Collects the responses to the requests in a JSON-RPC batch, so they
+    can be sent as one array, in the order of the requests.
+    """
 
     def __init__(self):
-        self._thread = None
-        self.shut_down = False
+        self.parts = []  # encoded responses, None while pending
+        self._positions = {}  # id -> index in parts
+        self.remaining = 0
+
+    def __contains__(self, id):
+        return id in self._positions
+
+    def expect(self, id):
+        """Reserve a place for the response to the request with this id."""
+        self._positions[id] = len(self.parts)
+        self.parts.append(None)
+        self.remaining += 1
+
+    def add_encoded(self, bb):
+        """Add a response that is already known, e.g. for an invalid message."""
+        self.parts.append(bb)
+
+    def add(self, id, bb):
+        """Add the response for a request. Returns True when complete."""
+        self.parts[self._positions[id]] = bb
+        self.remaining -= 1
+        return self.remaining == 0
+
+    def encode(self):
+        return b"[" + b",".join(self.parts) + b"]"
+
+
+# == The server
 
-    def start(self):
-        self._loop = asyncio.get_event_loop()
-        self._thread = IOThread(self._loop, self._dispatch)
-        self._thread.start()
+
+class LanguageServer:
+    """The language server object.
+
+    In daemon mode, there is one per connection (a session), which shares
+    the worker pool and the workspace index with the other sessions.
+    """
+
+    def __init__(self, startup=None, report_startup=False, daemon=None):
+        self.startup = startup or StartupTimer()
+        self.report_startup = report_startup
+        self.daemon = daemon
+        self.shut_down = False
+        self.stats = Stats()
+        self.stats_interval = 0  # seconds between logging the stats, 0 is off
+        self.documents = DocumentStore()
+        self.analyzer = Analyzer(self, daemon.pool if daemon else None)
+        self.workspace = WorkspaceIndex(self.analyzer.pool, daemon is not None)
+        self.semantic_tokens = SemanticTokensCache()
+        self.diagnostics = DiagnosticsPublisher(self)
+        self._scheduler = Scheduler(self)
+        self._batches = {}  # request id -> Batch that the request is part of
+        self._connection = None
+        self._mode = None
+        self._loop = daemon.loop if daemon else None
+
+    def start(self, mode="stdio", host="127.0.0.1", port=8339):
+        """Run the server, using stdio or tcp, until the exit notification."""
+        self._mode = mode
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        callbacks = self._on_message, self._on_close, self._on_connect
+        if mode == "tcp":
+            self._loop.run_until_complete(serve_tcp(host, port, *callbacks))
+        elif mode == "stdio":
+            self._loop.run_until_complete(open_stdio(*callbacks))
+        else:
+            raise ValueError(f"Invalid server mode: {mode!r}")
         logger.info("Entering main loop")
         self._loop.run_forever()
         logger.info("Main loop ended")
 
-    def _dispatch(self, request):
-        task = self._loop.create_task(self.handle_request(request))
+    def _on_connect(self, connection):
+        self.startup.mark("transport ready")
+        logger.info(f"{connection} connected")
+        if self._connection is not None and not self._connection.closed:
+            logger.warning("Replacing the existing client connection")
+        self._connection = connection
+
+    def _on_close(self, connection):
+        logger.info(f"{connection} closed")
+        if self._mode == "stdio":
+            self._loop.create_task(self._stop_when_idle())
+
+    def stop(self):
+        """Stop the server. In daemon mode, only end this session."""
+        if self.daemon is not None:
+            if self._connection is not None:
+                self._connection.close()  # the daemon calls close_session()
+            return
+        self.workspace.shutdown()
+        self.analyzer.shutdown()
+        self._loop.stop()
+
+    def close_session(self):
+        """Clean up, when the connection of a daemon session has closed."""
+        self.shut_down = True
+        self._scheduler.cancel_all()
+        self._batches.clear()
+        self.diagnostics.shutdown()
+        self.analyzer.shutdown()
+        self.daemon.release_workspace(self.workspace)
+
+    async def _stop_when_idle(self, timeout=2.0):
+        """Stop the loop, after giving pending handlers a chance to finish."""
+        current = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not current]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        self._loop.stop()
+
+    def _on_message(self, connection, payload):
+        self.startup.mark("first message")
+        t0 = time.perf_counter()
+        try:
+            d = codec.decode(payload)
+        except Exception:
+            logger.error("Could not convert content to JSON")
+        else:
+            if isinstance(d, list):
+                return self._on_batch(d, len(payload), time.perf_counter() - t0)
+            method_name = "response"
+            if isinstance(d, dict):
+                method_name = d.get("method", method_name)
+            decode_time = time.perf_counter() - t0
+            self.stats.record_received(method_name, len(payload), decode_time)
+            self._dispatch(d)
+
+    def _on_batch(self, messages, size, decode_time):
+        """Dispatch the messages of a JSON-RPC batch. They are scheduled in
+        order, like separate messages, so notifications of the same document
+        are still applied in order. The responses are sent together.
+        """
+        if not messages:
+            message = "Invalid request: empty batch"
+            error = {"code": INVALID_REQUEST, "message": message, "data": None}
+            self._write_response(None, None, error)
+            return
+        logger.info("Batch of %s messages", len(messages))
+        # The size and decode time are shared by the messages
+        size, decode_time = size // len(messages), decode_time / len(messages)
+        batch = Batch()
+        to_dispatch = []
+        for d in messages:
+            if not isinstance(d, dict) or "method" not in d:
+                message = "Invalid request: not a request or notification"
+            elif d.get("id", None) in batch or d.get("id", None) in self._batches:
+                message = f"Invalid request: duplicate id {d['id']!r}"
+            else:
+                self.stats.record_received(d["method"], size, decode_time)
+                if d.get("id", None) is not None:
+                    batch.expect(d["id"])
+                to_dispatch.append(d)
+                continue
+            error = {"code": INVALID_REQUEST, "message": message, "data": None}
+            batch.add_encoded(encode_response(None, None, error))
+        if batch.remaining:
+            for d in to_dispatch:
+                if d.get("id", None) is not None:
+                    self._batches[d["id"]] = batch
+        elif batch.parts and self._connection is not None:
+            self._connection.send(batch.encode())  # only invalid messages
+        for d in to_dispatch:
+            self._dispatch(d)
 
-    async def handle_request(self, d):
-        await asyncio.sleep(0.1)
+    def _dispatch(self, request):
+        self._scheduler.submit(request)
+
+    async def handle_request(self, d, queued_at=None, requests=None):
+        """Run the handler of a message, and respond to it. The requests
+        are (message, queued_at) tuples of equal requests that share the
+        response, d included. Requests may be removed from it (when they
+        are cancelled) while the handler runs.
+        """
+        t0 = time.perf_counter()
+        if queued_at is None:
+            queued_at = t0
+        if requests is None:
+            requests = [(d, queued_at)]
 
         id = d.get("id", None)
-        method_name = d.get("method", "no_method_name").replace("/", "_")
+        full_method_name = d.get("method", "no_method_name")
+        method_name = full_method_name.replace("/", "_")
         params = d.get("params", None)
 
-        logger.info(("Request" if id else "Notification") + " for " + method_name)
-        method = method_functions.get(method_name, None)
+        method = get_method(method_name)
+
+        # Unknown "$/" notifications may be ignored, as per the spec
+        if id is None and method is None and method_name.startswith("$_"):
+            return
+
+        kind = "Request" if id is not None else "Notification"
+        logger.info("%s for %s", kind, method_name)
+        uri = get_uri(d)
+        version = self._scheduler.get_version(uri)
+        error = None
         try:
             result = await method(self, params)
             # todo:  **params / *params (depending on whether params is a list or dict)
+        except asyncio.CancelledError:
+            for request, _ in requests:
+                id = request.get("id", None)
+                self._scheduler.untrack(id)
+                self.stats.record_cancelled(full_method_name, time.perf_counter() - t0)
+                message = "Request cancelled"
+                self._write_error(id, REQUEST_CANCELLED, message, full_method_name)
+            return
         except Exception as err:
-            # client cancelled: -32800
-            # server cancelled: -32802
-            # content modified: -32801
             error_msg = str(err)
-            error_code = -32603  # internal error
+            error_code = INTERNAL_ERROR
             if method is None:
-                error_code = -32601
+                error_code = METHOD_NOT_FOUND
                 error_msg = f"Method not implemented: {method_name}"
-
-            response = {
-                "jsonrpc": "2.0",
-                "id": id,
-                "error": {
-                    "code": error_code,
-                    "message": error_msg,
-                    "data": None,
-                },
-            }
-        else:
-            response = {
-                "jsonrpc": "2.0",
-                "id": id,
-                "result": result,
-            }
+            elif isinstance(err, RequestError):
+                error_code = err.code
+            result = None
+            error = {"code": error_code, "message": error_msg, "data": None}
+        for request, _ in requests:
+            self._scheduler.untrack(request.get("id", None))
+
+        # Drop the result if the document changed in the mean time
+        if id is not None and version != self._scheduler.get_version(uri):
+            if full_method_name not in DOCUMENT_SYNC:
+                run_time = time.perf_counter() - t0
+                for request, _ in requests:
+                    self.stats.record_content_modified(full_method_name, run_time)
+                    self._write_error(
+                        request["id"],
+                        CONTENT_MODIFIED,
+                        "Document has changed",
+                        full_method_name,
+                    )
+                return
+
+        for _, request_queued_at in requests:
+            self.stats.record(
+                full_method_name,
+                t0 - request_queued_at,
+                time.perf_counter() - t0,
+                error is not None,
+            )
 
         # If this is a notification, we should not send a response
         if id is None:
-            if response.get("error"):
-                logger.info(f"Error in notification: {response['error']['message']}")
+            if error is not None:
+                logger.info("Error in notification: %s", error["message"])
             else:
                 logger.info("Notification done.")
             return
 
+        for request, _ in requests:
+            self._write_response(request["id"], result, error, full_method_name)
+
+        # Apply backpressure when the client does not keep up
+        if self._connection is not None:
+            await self._connection.drain()
+
+    async def warm_up(self):
+        """Load and start everything that is not needed to answer initialize."""
+        self.startup.mark("initialized")
+        if self.stats_interval > 0:
+            self._loop.create_task(self._log_stats_periodically())
+        load_method_modules()
+        self.startup.mark("methods loaded")
+        await self.analyzer.warm_up()
+        self.startup.mark("workers ready")
+        if self.daemon is not None:
+            self.workspace = self.daemon.get_workspace(
+                self.workspace, self.workspace_folders, self.root_uri
+            )
+        else:
+            self.workspace.start(self.workspace_folders, self.root_uri)
+        logger.info("Startup (ms): " + json.dumps(self.startup.summary()))
+        if self.report_startup:
+            sys.stderr.write(self.startup.report() + "\n")
+            sys.stderr.flush()
+
+    def get_stats(self):
+        """Get a json-compatible dict with the stats of the server."""
+        connection = {}
+        c = self._connection
+        if c is not None:
+            connection = {
+                "frames_sent": c.frames_sent,
+                "writes": c.writes,
+                "bytes_written": c.bytes_written,
+            }
+        stats = {
+            "uptime": time.perf_counter() - self.stats.started,
+            "documents": len(self.documents),
+            "workspace_files": len(self.workspace),
+            "connection": connection,
+            "analysis": self.analyzer.get_stats(),
+            "diagnostics": self.diagnostics.get_stats(),
+            "methods": self.stats.summary(),
+        }
+        if self.daemon is not None:
+            stats["sessions"] = len(self.daemon.sessions)
+        return stats
+
+    async def _log_stats_periodically(self):
+        """Send the stats to the log (i.e. the log_listener) now and then."""
+        while not self.shut_down:
+            await asyncio.sleep(self.stats_interval)
+            logger.info("Stats: " + json.dumps(self.get_stats()))
+
+    def respond_error(self, d, code, message):
+        """Respond to a request with an error, without running it."""
+        method_name = d.get("method", "no_method_name")
+        if code == REQUEST_CANCELLED:
+            self.stats.record_cancelled(method_name)
+        elif code == CONTENT_MODIFIED:
+            self.stats.record_content_modified(method_name)
+        else:
+            self.stats.record(method_name, 0.0, 0.0, True)
+        self._write_error(d.get("id", None), code, message, method_name)
+
+    def send_notification(self, method_name, params):
+        """Send a notification to the client."""
+        t0 = time.perf_counter()
+        bb = codec.encode({"jsonrpc": "2.0", "method": method_name, "params": params})
+        self.stats.record_sent(method_name, len(bb), time.perf_counter() - t0)
+        connection = self._connection
+        if connection is None:
+            logger.warning("Cannot send notification: no client connection")
+            return
+        connection.send(bb)
+
+    def _write_error(self, id, code, message, method_name=None):
+        if id is None:
+            return  # a notification
+        error = {"code": code, "message": message, "data": None}
+        self._write_response(id, None, error, method_name)
+
+    def _write_response(self, id, result=None, error=None, method_name=None):
+        """Write a response. The result may be bytes with pre-encoded JSON."""
+
         # Prepare the response bytes
+        t0 = time.perf_counter()
         try:
-            text = json.dumps(response)
+            bb = encode_response(id, result, error)
         except Exception:
-            response = {
-                "jsonrpc": "2.0",
-                "id": id,
-                "error": {
-                    "code": -32603,
-                    "message": "failed to json-encode the response",
-                },
-            }
-            text = json.dumps(response)
-        bb = text.encode()
-
-        # Send the response
-        wfile = sys.stdout.buffer  # binary io
-        wfile.write(f"Content-Length: {len(bb)}\r\n".encode())
-        wfile.write(b"\r\n")
-        wfile.write(bb)
-        wfile.flush()
+            message = "failed to json-encode the response"
+            error = {"code": INTERNAL_ERROR, "message": message, "data": None}
+            bb = encode_response(id, None, error)
+        if method_name is not None:
+            encode_time = time.perf_counter() - t0
+            self.stats.record_sent(method_name, len(bb), encode_time)
+
+        # Send the response, or the whole batch when this completes it
+        batch = self._batches.pop(id, None) if id is not None else None
+        if batch is not None:
+            if not batch.add(id, bb):
+                return
+            bb = batch.encode()
+        connection = self._connection
+        if connection is None:
+            logger.warning("Cannot write result: no client connection")
+            return
+        connection.send(bb)
+        self.startup.mark("first response")
 
         # Log
-        if response.get("error"):
-            logger.info(f"Wrote result error: {response['error']['message']}")
+        if error is not None:
+            logger.info("Wrote result error: %s", error["message"])
         else:
             logger.info("Wrote result")
 
@@ -160,11 +459,36 @@ class LanguageServer:
 
 method_functions = {}
 
+# Modules that register methods. They are imported when a method is looked
+# up that is not registered (yet), or during warm-up, so that they are not
+# needed to answer "initialize".
+method_modules = [".methods", ".profiler"]
+
+
+def get_method(name):
+    """Get the function for the method with the given name, or None."""
+    func = method_functions.get(name, None)
+    if func is None and method_modules:
+        load_method_modules()
+        func = method_functions.get(name, None)
+    return func
+
 
-def register_method(func):
-    """Decorator"""
+def load_method_modules():
+    while method_modules:
+        import_module(method_modules.pop(0), __package__)
+
+
+def register_method(func=None, *, name=None):
+    """Decorator to register a method. The method name is derived from the
+    function name, unless a name is given, e.g. for "$/" methods.
+    """
+    if func is None:
+        return lambda func: register_method(func, name=name)
     assert asyncio.iscoroutinefunction(func)
-    method_functions[func.__name__] = func
+    name = name or func.__name__
+    method_functions[name.replace("/", "_")] = func
+    return func
 
 
 # == Builtin methods
@@ -180,19 +504,39 @@ async def initialize(server, params):
     server.client_capabilities = params["capabilities"]
     server.initialization_options = params.get("initializationOptions", None)
     server.workspace_folders = params.get("workspaceFolders", [])
+    server.root_uri = params.get("rootUri", None)
+    server.analyzer.configure(server.initialization_options)
+    options = server.initialization_options or {}
+    server.stats_interval = float(options.get("statsInterval", server.stats_interval))
+    server.workspace.configure(server.initialization_options)
+    server.diagnostics.configure(server.initialization_options)
+    general = server.client_capabilities.get("general", None) or {}
+    encoding = negotiate_encoding(general.get("positionEncodings", None))
+    server.documents.encoding = encoding
 
     # Create result
     server_capabilities = {
+        "positionEncoding": encoding,
         "textDocumentSync": {
             "openClose": True,
-            "change": 1,  # 1 means send full doc, 2 means incremental changes
+            "change": 2,  # 1 means send full doc, 2 means incremental changes
         },
         "completionProvider": {
             "triggerCharacters": ["."],
             "resolveProvider": False,  # can be true if we can provide additional info on items
             "completionItem": {},
         },
-        # "semanticTokensProvider": {},
+        "semanticTokensProvider": {
+            "legend": LEGEND,
+            "range": True,
+            "full": {"delta": True},
+        },
+        "definitionProvider": True,
+        "referencesProvider": True,
+        "documentHighlightProvider": True,
+        "documentSymbolProvider": True,
+        "foldingRangeProvider": True,
+        "workspaceSymbolProvider": True,
         # "documentFormattingProvider": {},
         # "documentRangeFormattingProvider": {},
         # "documentOnTypeFormattingProvider": {},
@@ -213,6 +557,7 @@ async def initialize(server, params):
 @register_method
 async def initialized(server, params):
     logger.info("Ininialization comfirmed by client!")
+    server._loop.create_task(server.warm_up())
     return None  # This is a notification
 
 
@@ -220,12 +565,28 @@ async def initialized(server, params):
 async def shutdown(server, params):
     logger.info("Server shutdown requested")
     server.shut_down = True
+    logger.info("Stats: " + json.dumps(server.get_stats()))
     # Now wait for exit
     return {}  # This is a request
 
 
+@register_method(name="$/zoof/stats")
+async def zoof_stats(server, params):
+    """Get the stats of the server. Pass {"reset": true} to reset them."""
+    result = server.get_stats()
+    if params and params.get("reset", False):
+        server.stats.reset()
+    return result
+
+
+@register_method(name="$/cancelRequest")
+async def cancel_request(server, params):
+    server._scheduler.cancel(params["id"])
+    return None  # This is a notification
+
+
 @register_method
 async def exit(server, params):
     logger.info("Server exit requested")
-    server._loop.stop()
+    server.stop()
     return None  # This is a notification
@@ -0,0 +1,117 @@
+"""
+Timing of the server startup.
+
+The StartupTimer records milestones (imports done, transport up, first
+response, warm-up done), relative to the start of the main function. The
+ImportTimer measures the imports, similar to "python -X importtime", so
+that the report shows what the startup time is spent on.
+
+This module is imported before anything else, so it should stay light.
+"""
+
+import sys
+import time
+
+
+class StartupTimer:
+    """Records the time of startup milestones."""
+
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.marks = {}  # name -> seconds since t0
+        self.import_timer = None
+
+    def mark(self, name):
+        """Mark a milestone. Only the first time counts."""
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - self.t0
+
+    def get(self, name):
+        return self.marks.get(name, None)
+
+    def summary(self):
+        """Get a dict with the milestones in ms."""
+        return {name: round(1000 * t, 1) for name, t in self.marks.items()}
+
+    def report(self, max_imports=15):
+        """Get a multi-line report of the startup."""
+        lines = ["Startup timing (ms since start of main):"]
+        for name, t in self.marks.items():
+            lines.append(f"  {1000 * t:8.1f}  {name}")
+        if self.import_timer is not None:
+            lines.append(self.import_timer.report(max_imports))
+        return "\n".join(lines)
+
+
+class ImportTimer:
+    """A meta path finder that measures the time of each import, like
+    "python -X importtime": self time and cumulative time per module.
+    """
+
+    def __init__(self):
+        self.times = {}  # module name -> (self time, cumulative time, depth)
+        self._stack = []  # [name, start time, time in nested imports]
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path=None, target=None):
+        # Find the spec with the other finders, and wrap its loader
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def _enter(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def _exit(self):
+        name, t0, nested = self._stack.pop()
+        cumulative = time.perf_counter() - t0
+        self.times[name] = cumulative - nested, cumulative, len(self._stack)
+        if self._stack:
+            self._stack[-1][2] += cumulative
+
+    def report(self, max_imports=15):
+        """Get the slowest top-level imports, and the modules with the
+        largest self time.
+        """
+        times = self.times
+        total = sum(cum for _, cum, depth in times.values() if depth == 0)
+        lines = [f"Imports: {len(times)} modules in {1000 * total:0.1f} ms"]
+        lines.append("      self |  cumulative | module")
+        by_self = sorted(times.items(), key=lambda item: -item[1][0])
+        for name, (self_time, cum, _) in by_self[:max_imports]:
+            lines.append(f"  {1000 * self_time:8.1f} | {1000 * cum:11.1f} | {name}")
+        return "\n".join(lines)
+
+
+class _TimedLoader:
+    """Wraps a loader to time exec_module()."""
+
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer._enter(module.__name__)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer._exit()
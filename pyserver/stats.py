@@ -0,0 +1,202 @@
+"""
+Lightweight per-method counters, to see where the time goes.
+
+Per method, this keeps the size of the incoming messages, the time to
+decode them, the time they wait in the queue, the time in the handler, the
+time to encode the response, and the number of bytes written. Times are
+measured with time.perf_counter(), which is monotonic.
+"""
+
+import time
+import math
+
+
+# Histogram buckets are spaced a quarter octave apart, starting at 1 us.
+# With 96 buckets that covers up to 2**24 us, about 16 seconds.
+BUCKETS_PER_OCTAVE = 4
+BUCKET_COUNT = 96
+
+
+def _bucket_index(t):
+    us = t * 1e6
+    if us <= 1:
+        return 0
+    i = int(math.log2(us) * BUCKETS_PER_OCTAVE) + 1
+    return min(i, BUCKET_COUNT - 1)
+
+
+def _bucket_upper(i):
+    return 2 ** (i / BUCKETS_PER_OCTAVE) / 1e6
+
+
+class Histogram:
+    """A log-scale histogram of durations (in seconds)."""
+
+    __slots__ = ["counts", "count", "total", "max"]
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, t):
+        self.counts[_bucket_index(t)] += 1
+        self.count += 1
+        self.total += t
+        if t > self.max:
+            self.max = t
+
+    def percentile(self, p):
+        """Get (an upper bound of) the given percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        threshold = self.count * p / 100
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= threshold:
+                return min(_bucket_upper(i), self.max)
+        return self.max
+
+    def summary(self):
+        """Get a dict with the mean and percentiles, in milliseconds."""
+        ms = 1000
+        return {
+            "mean": ms * self.total / self.count if self.count else 0.0,
+            "p50": ms * self.percentile(50),
+            "p95": ms * self.percentile(95),
+            "p99": ms * self.percentile(99),
+            "max": ms * self.max,
+        }
+
+
+class MethodStats:
+    """The counters for a single method."""
+
+    __slots__ = [
+        "count",
+        "errors",
+        "queue_time",
+        "run_time",
+        "cancelled",
+        "content_modified",
+        "wasted_time",
+        "received",
+        "bytes_in",
+        "max_in",
+        "decode_time",
+        "sent",
+        "bytes_out",
+        "max_out",
+        "encode_time",
+    ]
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.queue_time = Histogram()
+        self.run_time = Histogram()
+        self.cancelled = 0  # cancelled requests
+        self.content_modified = 0  # results dropped because the doc changed
+        self.wasted_time = 0.0  # time spent on cancelled / dropped requests
+        self.received = 0  # incoming messages
+        self.bytes_in = 0
+        self.max_in = 0
+        self.decode_time = Histogram()
+        self.sent = 0  # responses
+        self.bytes_out = 0
+        self.max_out = 0
+        self.encode_time = Histogram()
+
+    def saved_time(self):
+        """Estimate the handler time that was saved by cancellation."""
+        if not self.run_time.count:
+            return 0.0
+        mean = self.run_time.total / self.run_time.count
+        return max(0.0, mean * self.cancelled - self.wasted_time)
+
+
+class Stats:
+    """Keeps counters and timing histograms per method."""
+
+    def __init__(self):
+        self._methods = {}
+        self.started = time.perf_counter()
+
+    def get(self, method_name):
+        try:
+            return self._methods[method_name]
+        except KeyError:
+            ms = self._methods[method_name] = MethodStats()
+            return ms
+
+    def record(self, method_name, queue_time, run_time, error=False):
+        """Record a handled message. Times are in seconds."""
+        ms = self.get(method_name)
+        ms.count += 1
+        ms.errors += bool(error)
+        ms.queue_time.add(queue_time)
+        ms.run_time.add(run_time)
+
+    def record_received(self, method_name, size, decode_time):
+        """Record an incoming message, its size in bytes, and decode time."""
+        ms = self.get(method_name)
+        ms.received += 1
+        ms.bytes_in += size
+        ms.max_in = max(ms.max_in, size)
+        ms.decode_time.add(decode_time)
+
+    def record_sent(self, method_name, size, encode_time):
+        """Record a response, its size in bytes, and encode time."""
+        ms = self.get(method_name)
+        ms.sent += 1
+        ms.bytes_out += size
+        ms.max_out = max(ms.max_out, size)
+        ms.encode_time.add(encode_time)
+
+    def record_cancelled(self, method_name, run_time=0.0):
+        """Record a cancelled request, and the time it ran before that."""
+        ms = self.get(method_name)
+        ms.cancelled += 1
+        ms.wasted_time += run_time
+
+    def record_content_modified(self, method_name, run_time=0.0):
+        """Record a request whose result was dropped because the doc changed."""
+        ms = self.get(method_name)
+        ms.content_modified += 1
+        ms.wasted_time += run_time
+
+    def reset(self):
+        self._methods.clear()
+        self.started = time.perf_counter()
+
+    def summary(self):
+        """Get a json-compatible dict with the stats of all methods.
+        Times are in milliseconds, sizes in bytes.
+        """
+        result = {}
+        for method_name, ms in sorted(self._methods.items()):
+            result[method_name] = {
+                "count": ms.count,
+                "errors": ms.errors,
+                "decode_time": ms.decode_time.summary(),
+                "queue_time": ms.queue_time.summary(),
+                "run_time": ms.run_time.summary(),
+                "encode_time": ms.encode_time.summary(),
+                "bytes_in": {
+                    "total": ms.bytes_in,
+                    "mean": ms.bytes_in / ms.received if ms.received else 0,
+                    "max": ms.max_in,
+                },
+                "bytes_out": {
+                    "total": ms.bytes_out,
+                    "mean": ms.bytes_out / ms.sent if ms.sent else 0,
+                    "max": ms.max_out,
+                },
+                "cancelled": ms.cancelled,
+                "content_modified": ms.content_modified,
+                "wasted_time": 1000 * ms.wasted_time,
+                "saved_time": 1000 * ms.saved_time(),
+            }
+        return result
@@ -0,0 +1,230 @@
+"""
+Transports to talk to the client, based on asyncio.
+
+Incoming bytes are framed into message payloads (see framing.py) and passed
+to a callback. Outgoing payloads are framed and queued; all frames that are
+ready in the same event loop iteration go out in a single write. Writes are
+non-blocking; flow control from the underlying transport is exposed via
+Connection.drain().
+"""
+
+import sys
+import asyncio
+import threading
+
+from .utils import logger
+from .framing import FrameParser, make_header
+
+
+READ_CHUNK_SIZE = 2**16
+
+
+class Connection(asyncio.Protocol):
+    """A connection to a single client.
+
+    This object is the asyncio protocol for the incoming data. For a socket
+    the same transport is used for writing; for stdio a separate pipe
+    transport is attached with set_write_transport().
+    """
+
+    def __init__(self, on_message, on_close):
+        self._on_message = on_message  # called with (connection, payload)
+        self._on_close = on_close  # called with (connection)
+        self._parser = FrameParser()
+        self._read_transport = None
+        self._write_transport = None
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        self._outbox = []
+        self._flush_scheduled = False
+        self.closed = False  # True when the client stopped sending
+        self.frames_sent = 0
+        self.writes = 0
+        self.bytes_written = 0
+
+    def __repr__(self):
+        peer = None
+        if self._read_transport is not None:
+            peer = self._read_transport.get_extra_info("peername")
+        return f"<Connection {peer or 'stdio'}>"
+
+    # Reading
+
+    def connection_made(self, transport):
+        self._read_transport = transport
+        if self._write_transport is None:
+            if isinstance(transport, asyncio.WriteTransport):
+                self._write_transport = transport
+
+    def data_received(self, data):
+        for payload in self._parser.feed(data):
+            self._on_message(self, payload)
+
+    def eof_received(self):
+        return False  # close the transport
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logger.error(f"Connection lost: {str(exc)}")
+        self._set_closed()
+
+    def _set_closed(self):
+        if not self.closed:
+            self.closed = True
+            self._can_write.set()  # don't block writers forever
+            self._on_close(self)
+
+    # Writing
+
+    def set_write_transport(self, transport):
+        self._write_transport = transport
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+        self._schedule_flush()
+
+    def send(self, payload):
+        """Queue a message payload to be sent to the client. Does not block.
+
+        Frames are never interleaved, and are sent in the order of this call.
+        """
+        self._outbox.append(make_header(len(payload)))
+        self._outbox.append(payload)
+        self.frames_sent += 1
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._outbox and not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if not self._can_write.is_set():
+            return  # resume_writing() will schedule a new flush
+        if self._outbox:
+            data = b"".join(self._outbox)
+            self._outbox.clear()
+            self.write(data)
+
+    def write(self, bb):
+        """Write raw bytes to the client. Does not block."""
+        transport = self._write_transport
+        if transport is not None and not transport.is_closing():
+            transport.write(bb)
+            self.writes += 1
+            self.bytes_written += len(bb)
+
+    async def drain(self):
+        """Wait until the client has consumed enough of the written data."""
+        await self._can_write.wait()
+
+    def close(self):
+        self._flush()
+        for transport in (self._write_transport, self._read_transport):
+            if transport is not None:
+                transport.close()
+        self._set_closed()
+
+
+class _WriteProtocol(asyncio.BaseProtocol):
+    """Forwards the flow control of a write pipe to the connection."""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def pause_writing(self):
+        self._connection.pause_writing()
+
+    def resume_writing(self):
+        self._connection.resume_writing()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logger.error(f"Write pipe lost: {str(exc)}")
+        self._connection.resume_writing()  # don't block writers forever
+
+
+class _StdinThread(threading.Thread):
+    """Fallback to read stdin when it cannot be used as an asyncio pipe.
+
+    E.g. when stdin is a regular file, or on event loops that do not support
+    pipes. Raw chunks are handed to the connection in the loop's thread.
+    """
+
+    def __init__(self, loop, connection):
+        super().__init__()
+        self._loop = loop
+        self._connection = connection
+        self.daemon = True
+
+    def run(self):
+        rfile = sys.stdin.buffer
+        try:
+            while True:
+                data = rfile.read1(READ_CHUNK_SIZE)
+                if not data:
+                    break  # stdin is closed
+                self._loop.call_soon_threadsafe(self._connection.data_received, data)
+        except Exception as err:
+            logger.error(f"stdin thread errored: {str(err)}")
+        self._loop.call_soon_threadsafe(self._connection.connection_lost, None)
+
+
+class _BlockingWriteTransport(asyncio.WriteTransport):
+    """Fallback for when stdout cannot be used as an asyncio pipe."""
+
+    def __init__(self, wfile):
+        super().__init__()
+        self._wfile = wfile
+
+    def write(self, bb):
+        self._wfile.write(bb)
+        self._wfile.flush()
+
+    def is_closing(self):
+        return self._wfile.closed
+
+    def close(self):
+        pass
+
+
+async def open_stdio(on_message, on_close, on_connect):
+    """Connect to the client via stdin and stdout. Returns the Connection."""
+    loop = asyncio.get_running_loop()
+    connection = Connection(on_message, on_close)
+    on_connect(connection)
+
+    try:
+        transport, _ = await loop.connect_write_pipe(
+            lambda: _WriteProtocol(connection), sys.stdout.buffer
+        )
+    except Exception as err:
+        logger.warning(f"Using blocking writes for stdout: {str(err)}")
+        transport = _BlockingWriteTransport(sys.stdout.buffer)
+    connection.set_write_transport(transport)
+
+    try:
+        await loop.connect_read_pipe(lambda: connection, sys.stdin.buffer)
+    except Exception as err:
+        logger.warning(f"Using a thread to read stdin: {str(err)}")
+        _StdinThread(loop, connection).start()
+
+    return connection
+
+
+async def serve_tcp(host, port, on_message, on_close, on_connect):
+    """Start a TCP server. Returns the asyncio.Server."""
+    loop = asyncio.get_running_loop()
+
+    def factory():
+        connection = Connection(on_message, on_close)
+        on_connect(connection)
+        return connection
+
+    server = await loop.create_server(factory, host, port)
+    logger.info(f"Listening on {host}:{port}")
+    return server
@@ -1,25 +1,86 @@
+import json
 import socket
 import logging
+import threading
+import collections
 
 logger = logging.getLogger("simple_lsp")
 logger.setLevel(logging.INFO)
 
 
 class UDPHandler(logging.Handler):
+    """Sends log records over UDP, from a background thread.
+
+    Records are put in a bounded ring buffer; when it is full, records are
+    dropped rather than blocking the caller. The background thread formats
+    the records and packs them into as few datagrams as possible.
+    """
+
     udp_address = ("127.0.0.1", 12012)
+    datagram_size = 2**13  # below the default max on MacOS (9216)
+    buffer_size = 2**14  # max number of records waiting to be sent
 
     def __init__(self):
         super().__init__()
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._buffer = collections.deque()
+        self._event = threading.Event()
+        self._send_lock = threading.Lock()
+        self.dropped = 0
+        self._dropped_reported = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
 
     def emit(self, record):
-        msg = self.format(record)
-        bb = msg.encode()
-        size = 2**10
-        while bb:
-            bb1 = bb[:size]
-            bb = bb[size:]
-            self._socket.sendto(bb1, self.udp_address)
+        # Called in the thread that logs; do as little as possible
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._buffer.append(record)
+        if not self._event.is_set():
+            self._event.set()
+
+    def flush(self):
+        self._send_pending()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            self._send_pending()
+
+    def _send_pending(self):
+        with self._send_lock:
+            batch = bytearray()
+            buffer = self._buffer
+            while buffer:
+                record = buffer.popleft()
+                try:
+                    bb = self.format(record).encode()
+                except Exception:
+                    self.handleError(record)
+                    continue
+                if len(batch) + len(bb) + 1 > self.datagram_size:
+                    self._send(batch)
+                    batch.clear()
+                if batch:
+                    batch += b"\n"
+                batch += bb
+            if self.dropped > self._dropped_reported:
+                n = self.dropped - self._dropped_reported
+                self._dropped_reported = self.dropped
+                self._send(batch)
+                batch = bytearray(f"[dropped {n} log records]".encode())
+            self._send(batch)
+
+    def _send(self, bb):
+        view = memoryview(bb)
+        size = self.datagram_size
+        for i in range(0, len(view), size):
+            try:
+                self._socket.sendto(view[i : i + size], self.udp_address)
+            except OSError:
+                pass  # Nobody is listening, or the message is too big
 
 
 for handler in logging.root.handlers:
@@ -0,0 +1,426 @@
+"""
+An index of the top-level definitions in all the files of the workspace.
+
+The workspace folders are crawled in the background, and the files are
+parsed in the analysis workers. The results are persisted in an SQLite
+database, keyed by path, mtime and content hash, so that after a restart
+the index is loaded from disk, and only the files that changed are parsed
+again. A file that was touched but not changed is recognized by its hash.
+
+The index backs workspace/symbol and cross-file completion, and is kept
+current via workspace/didChangeWatchedFiles.
+"""
+
+import os
+import json
+import time
+import asyncio
+from urllib.parse import urlparse, unquote
+
+from .utils import logger
+from .conv import symbolkind2int
+from .documents import count_units, DEFAULT_ENCODING
+from .completion import CompletionIndex, make_workspace_item, MAX_ITEMS
+
+
+FILE_EXTENSION = ".zf"
+SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv"}
+
+# Bump this when the extracted symbols change, to invalidate the caches
+INDEX_VERSION = 2
+
+# The number of files that are sent to a worker in one job
+BATCH_SIZE = 32
+
+# Watched-file change types
+FILE_CREATED = 1
+FILE_CHANGED = 2
+FILE_DELETED = 3
+
+_symbol_kinds = {
+    "func": "Function",
+    "proc": "Function",
+    "method": "Method",
+    "getter": "Property",
+    "setter": "Property",
+    "struct": "Struct",
+    "trait": "Interface",
+    "variable": "Variable",
+}
+
+
+def get_cache_dir():
+    """Get the directory of the files that the server writes."""
+    cache_dir = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "zoof-lsp")
+
+
+def get_cache_path():
+    """Get the default path of the index cache."""
+    return os.path.join(get_cache_dir(), "workspace-index.sqlite")
+
+
+def is_in_cache_dir(path):
+    """Get whether a path is in the cache directory, after resolving symlinks
+    and "..". In daemon mode, clients may only have files written there.
+    """
+    cache_dir = os.path.realpath(get_cache_dir())
+    try:
+        return os.path.commonpath([cache_dir, os.path.realpath(path)]) == cache_dir
+    except ValueError:
+        return False  # e.g. another drive
+
+
+def uri_to_path(uri):
+    """Convert a file uri to a filesystem path, or None for other schemes."""
+    parsed = urlparse(uri)
+    if parsed.scheme != "file":
+        return None
+    path = unquote(parsed.path)
+    if os.name == "nt":
+        from urllib.request import url2pathname  # slow import
+
+        path = url2pathname(path)
+    return path
+
+
+def path_to_uri(path):
+    from pathlib import Path
+
+    return Path(path).as_uri()
+
+
+# == Running in worker processes
+
+
+def extract_symbols(text):
+    """Get the top-level definitions in the given source, as a list of
+    (name, line, column, kind, head), with the column a str index. The head
+    is the text before the name if it is not ASCII (which is rare), so that
+    the column can be converted to any position encoding, else "".
+    """
+    from .analysis import analyze
+
+    lines = text.split("\n")
+    _, scopes = analyze(text)
+    symbols = []
+    for name, line, column, kind in scopes.root.definitions:
+        head = lines[line][:column]
+        symbols.append((name, line, column, kind, "" if head.isascii() else head))
+    return symbols
+
+
+def index_files(jobs):
+    """Index a batch of files, given as (path, known hash) tuples.
+
+    Returns a list of (path, mtime_ns, size, hash, symbols). The symbols are
+    None if the hash matches the known hash. The mtime is None if the file
+    could not be read.
+    """
+    import hashlib
+
+    results = []
+    for path, known_hash in jobs:
+        try:
+            st = os.stat(path)
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            results.append((path, None, 0, None, None))
+            continue
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        symbols = None
+        if digest != known_hash:
+            symbols = extract_symbols(data.decode("utf-8", errors="replace"))
+        results.append((path, st.st_mtime_ns, st.st_size, digest, symbols))
+    return results
+
+
+# == Running in the server
+
+
+def scan_folders(folders):
+    """Get a dict path -> (mtime_ns, size) for the source files in the folders."""
+    found = {}
+    for folder in folders:
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [
+                d for d in dirnames if d not in SKIP_DIRS and not d.startswith(".")
+            ]
+            for filename in filenames:
+                if filename.endswith(FILE_EXTENSION):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = st.st_mtime_ns, st.st_size
+    return found
+
+
+class IndexCache:
+    """The on-disk cache of the workspace index, in an SQLite database.
+
+    The methods are blocking, and are called from a single thread.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != INDEX_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS files")
+            self._db.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, "
+            "hash TEXT, symbols TEXT)"
+        )
+        self._db.commit()
+
+    def load(self, folders):
+        """Get a dict path -> (mtime_ns, size, hash, symbols) for the files
+        in the given folders.
+        """
+        entries = {}
+        query = "SELECT path, mtime, size, hash, symbols FROM files"
+        prefixes = tuple(os.path.join(folder, "") for folder in folders)
+        for path, mtime, size, digest, symbols in self._db.execute(query):
+            if path.startswith(prefixes):
+                symbols = [tuple(symbol) for symbol in json.loads(symbols)]
+                entries[path] = mtime, size, digest, symbols
+        return entries
+
+    def store(self, entries):
+        """Store a list of (path, mtime_ns, size, hash, symbols)."""
+        rows = [
+            (path, mtime, size, digest, json.dumps(symbols))
+            for path, mtime, size, digest, symbols in entries
+        ]
+        self._db.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)", rows)
+        self._db.commit()
+
+    def delete(self, paths):
+        self._db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def get_folder_paths(workspace_folders, root_uri=None):
+    """Get the paths of the given workspace folders (list of dicts), or of
+    the root uri if there are no folders.
+    """
+    uris = [folder["uri"] for folder in workspace_folders or ()]
+    if not uris and root_uri:
+        uris = [root_uri]
+    return [path for path in map(uri_to_path, uris) if path]
+
+
+class WorkspaceIndex:
+    """Keeps the top-level definitions of all source files in the workspace.
+
+    In daemon mode, an index is shared by the sessions that have the same
+    workspace folders, and it is restricted: the client can only put the
+    index cache in the cache directory.
+    """
+
+    def __init__(self, pool, restricted=False):
+        self._pool = pool  # the WorkerPool
+        self.restricted = restricted
+        self.cache_path = get_cache_path()
+        self.folders = []
+        self._files = {}  # path -> (mtime_ns, size, hash, symbols)
+        self._pending = {}  # path -> known hash, files to (re)index
+        self._cache = None
+        self._thread = None  # for blocking work: the cache and scanning
+        self._task = None
+        self._completion = None  # CompletionIndex, built when needed
+        self._symbols = None  # flat list for workspace/symbol, built when needed
+
+    def configure(self, options):
+        """Apply initialization options."""
+        options = options or {}
+        cache_path = options.get("workspaceIndexCache", self.cache_path)
+        if self.restricted and cache_path and not is_in_cache_dir(cache_path):
+            logger.warning(f"Ignoring workspaceIndexCache outside {get_cache_dir()}")
+        else:
+            self.cache_path = cache_path
+
+    def __len__(self):
+        return len(self._files)
+
+    def start(self, workspace_folders, root_uri=None):
+        """Start indexing the given workspace folders (list of dicts)."""
+        self.folders = get_folder_paths(workspace_folders, root_uri)
+        if self.folders and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._crawl())
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._thread is not None:
+            if self._cache is not None:
+                self._thread.submit(self._cache.close)
+                self._cache = None
+            self._thread.shutdown(wait=True)
+            self._thread = None
+
+    def files_changed(self, changes):
+        """Handle a list of FileEvent's, from workspace/didChangeWatchedFiles."""
+        deleted = []
+        for change in changes:
+            path = uri_to_path(change["uri"])
+            if not path or not path.endswith(FILE_EXTENSION):
+                continue
+            if change["type"] == FILE_DELETED:
+                self._pending.pop(path, None)
+                if self._files.pop(path, None) is not None:
+                    deleted.append(path)
+            else:
+                entry = self._files.get(path, None)
+                self._pending[path] = entry[2] if entry else None
+        if deleted:
+            self._invalidate()
+            if self._cache is not None:
+                self._run_in_thread(self._cache.delete, deleted)
+        if self._pending and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._process())
+
+    def _run_in_thread(self, func, *args):
+        if self._thread is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._thread = ThreadPoolExecutor(1, thread_name_prefix="workspace")
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._thread, func, *args)
+
+    def _invalidate(self):
+        self._completion = None
+        self._symbols = None
+
+    async def _crawl(self):
+        t0 = time.perf_counter()
+        try:
+            if self.cache_path:
+                self._cache = await self._run_in_thread(IndexCache, self.cache_path)
+                self._files = await self._run_in_thread(self._cache.load, self.folders)
+                self._invalidate()
+        except Exception as err:
+            logger.warning(f"Cannot use the index cache {self.cache_path}: {err}")
+            self._cache = None
+        t1 = time.perf_counter()
+        logger.info(f"Loaded {len(self._files)} files from the index cache")
+
+        found = await self._run_in_thread(scan_folders, self.folders)
+        deleted = [path for path in self._files if path not in found]
+        for path in deleted:
+            self._files.pop(path)
+        if deleted:
+            self._invalidate()
+            if self._cache is not None:
+                await self._run_in_thread(self._cache.delete, deleted)
+        for path, (mtime, size) in found.items():
+            entry = self._files.get(path, None)
+            if entry is None:
+                self._pending[path] = None
+            elif entry[0] != mtime or entry[1] != size:
+                self._pending[path] = entry[2]
+        t2 = time.perf_counter()
+        logger.info(
+            f"Found {len(found)} files, {len(self._pending)} to index "
+            f"(load {1000 * (t1 - t0):0.0f} ms, scan {1000 * (t2 - t1):0.0f} ms)"
+        )
+        await self._process()
+
+    async def _process(self):
+        """Index the pending files, one batch at a time, so that the
+        workers stay available for the analysis of open documents.
+        """
+        t0 = time.perf_counter()
+        count = 0
+        try:
+            while self._pending:
+                jobs = []
+                while self._pending and len(jobs) < BATCH_SIZE:
+                    jobs.append(self._pending.popitem())
+                results = await self._pool.run(index_files, jobs)
+                changed = []
+                for path, mtime, size, digest, symbols in results:
+                    if mtime is None:
+                        self._files.pop(path, None)
+                        continue
+                    if symbols is None:
+                        # The content did not change
+                        entry = self._files.get(path, None)
+                        if entry is None:
+                            self._pending[path] = None  # removed in the mean time
+                            continue
+                        symbols = entry[3]
+                    entry = self._files[path] = mtime, size, digest, symbols
+                    changed.append((path, *entry))
+                count += len(results)
+                self._invalidate()
+                if self._cache is not None and changed:
+                    await self._run_in_thread(self._cache.store, changed)
+        except Exception as err:
+            logger.error(f"Indexing the workspace failed: {err}")
+        finally:
+            self._task = None
+        if count:
+            t1 = time.perf_counter()
+            logger.info(f"Indexed {count} files in {t1 - t0:0.2f} s")
+
+    # Queries
+
+    def _get_symbols(self):
+        if self._symbols is None:
+            self._symbols = [
+                (name.lower(), name, line, column, kind, head, path)
+                for path, entry in self._files.items()
+                for name, line, column, kind, head in entry[3]
+            ]
+        return self._symbols
+
+    def symbols(self, query, encoding=DEFAULT_ENCODING, max_items=MAX_ITEMS):
+        """Get a list of SymbolInformation for the symbols matching the
+        query, with positions in the given position encoding.
+        """
+        query = query.lower()
+        result = []
+        for key, name, line, column, kind, head, path in self._get_symbols():
+            if query in key:
+                if head:
+                    column = count_units(head, encoding)
+                end = column + count_units(name, encoding)
+                position = {"line": line, "character": column}
+                end = {"line": line, "character": end}
+                location = {
+                    "uri": path_to_uri(path),
+                    "range": {"start": position, "end": end},
+                }
+                result.append(
+                    {
+                        "name": name,
+                        "kind": symbolkind2int(_symbol_kinds.get(kind, "Variable")),
+                        "location": location,
+                        "containerName": os.path.basename(path),
+                    }
+                )
+                if len(result) >= max_items:
+                    break
+        return result
+
+    def completion_items(self, prefix, max_items=MAX_ITEMS):
+        """Get (items, is_incomplete) for the symbols that start with prefix."""
+        if self._completion is None:
+            self._completion = CompletionIndex(
+                make_workspace_item(name, kind, os.path.basename(path))
+                for _, name, _, _, kind, _, path in self._get_symbols()
+            )
+        return self._completion.lookup(prefix, max_items)
@@ -52,10 +52,10 @@ export function activate(context: ExtensionContext) {
 
     const clientOptions: LanguageClientOptions = {
         documentSelector: [{ scheme: "file", language: "zoof" }],
-        // synchronize: {
-        //     // Notify the server about file changes to '.clientrc files contained in the workspace
-        //     fileEvents: workspace.createFileSystemWatcher('**/.clientrc')
-        // }
+        synchronize: {
+            // Notify the server about changes to source files, to keep its index current
+            fileEvents: workspace.createFileSystemWatcher("**/*.zf"),
+        },
     };
 
     client = new LanguageClient(
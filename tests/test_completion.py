@@ -0,0 +1,31 @@
+"""
+Tests for the prefix lookups of completion.
+"""
+
+from pyserver.completion import CompletionIndex, get_prefix
+
+
+def make_index(labels):
+    return CompletionIndex({"label": label} for label in labels)
+
+
+def test_lookup_prefix():
+    index = make_index(["ab", "a\U0001d465", "a￿z", "b", "Abc"])
+    items, is_incomplete = index.lookup("a")
+    labels = {item["label"] for item in items}
+    assert labels == {"ab", "a\U0001d465", "a￿z", "Abc"}
+    assert not is_incomplete
+
+
+def test_lookup_max_items():
+    index = make_index(["a", "b", "c"])
+    assert len(index.lookup("", 2)[0]) == 2
+    assert index.lookup("", 2)[1]
+    assert len(index.lookup("")[0]) == 3
+    assert not index.lookup("")[1]
+
+
+def test_get_prefix():
+    assert get_prefix("x = größe", 9) == ("größe", False)
+    assert get_prefix("foo.b\U0001d465", 6) == ("b\U0001d465", True)
+    assert get_prefix("x = ", 4) == ("", False)
@@ -0,0 +1,81 @@
+"""
+Tests for the incremental updates of the token stream: after random edits,
+TokenStream.update() must give the same tokens as lexing the new text.
+"""
+
+import random
+
+import pytest
+
+from pyserver.analysis import analyze
+from pyserver.benchmark import make_source
+from pyserver.documents import Document
+from pyserver.lexer import TokenStream
+
+
+SNIPPETS = [
+    "x",
+    "'",
+    "\n",
+    "\r\n",
+    "\r",
+    "# note",
+    "#### output\n",
+    "#### output\r\nfoo 'x\r\n",
+    "#### end",
+    "\n    y = 2\n",
+    "func f(a)\r\n",
+    "",
+]
+
+ATTRIBUTES = ["columns", "lengths", "kinds", "line_counts", "line_states"]
+
+
+def make_text(r, line_ending):
+    text = make_source(60, r.randrange(100))
+    text += "#### output\nfoo 'x\n#### end\n" + make_source(20)
+    return text.replace("\n", line_ending)
+
+
+def random_change(r, doc):
+    line1 = r.randrange(doc.line_count)
+    line2 = min(doc.line_count - 1, line1 + r.choice([0, 0, 1, 3]))
+    char1 = r.randint(0, len(doc.get_line(line1)))
+    char2 = r.randint(0, len(doc.get_line(line2)))
+    if line2 == line1:
+        char1, char2 = min(char1, char2), max(char1, char2)
+    return {
+        "range": {
+            "start": {"line": line1, "character": char1},
+            "end": {"line": line2, "character": char2},
+        },
+        "text": r.choice(SNIPPETS),
+    }
+
+
+def assert_same_tokens(tokens, expected):
+    for name in ATTRIBUTES:
+        assert getattr(tokens, name) == getattr(expected, name), name
+    for line in range(tokens.line_count):
+        assert tokens.line_range(line) == expected.line_range(line)
+    for i in range(len(tokens)):
+        assert tokens.line_of(i) == expected.line_of(i)
+
+
+@pytest.mark.parametrize("line_ending", ["\n", "\r\n"])
+@pytest.mark.parametrize("seed", range(4))
+def test_update_matches_full_lex(seed, line_ending):
+    r = random.Random(seed)
+    doc = Document("file:///test.zf", 1, make_text(r, line_ending))
+    tokens, _ = analyze(doc.text)
+    for version in range(2, 80):
+        old_version = doc.version
+        changes = [random_change(r, doc) for _ in range(r.randint(1, 3))]
+        doc.apply_changes(version, changes)
+        tokens.update(doc.get_line, doc.line_count, doc.get_edits(old_version))
+        doc.drop_edits(version)
+
+        lines = [doc.get_line(i) for i in range(doc.line_count)]
+        assert_same_tokens(tokens, TokenStream.from_lines(lines))
+        # The full analysis in the workers lexes the text itself
+        assert_same_tokens(tokens, analyze(doc.text)[0])
@@ -0,0 +1,101 @@
+"""
+Tests for the incremental updates of the scope tree: ScopeIndex.apply_edit()
+must give the same tree as build_scopes() on the edited text, for edits
+that keep the structure, i.e. that replace statements with statements at
+the same indentation.
+"""
+
+import re
+import random
+
+import pytest
+
+from pyserver.benchmark import make_source
+from pyserver.lexer import TokenStream
+from pyserver.scopes import build_scopes, BLOCK_KEYWORDS, MODIFIER_KEYWORDS
+
+
+STATEMENTS = ["print(total)", "compute0(a, b)", "return a", "b int"]
+
+
+def build(lines):
+    return build_scopes(lines.__getitem__, TokenStream.from_lines(lines))
+
+
+def is_statement(text):
+    """Whether a line has code that does not open a block or define a name."""
+    stripped = text.strip()
+    if not stripped or stripped.startswith("#"):
+        return False
+    word = re.match(r"\w*", stripped).group(0)
+    if word in BLOCK_KEYWORDS or word in MODIFIER_KEYWORDS:
+        return False
+    return not re.match(r"\w+\s*=[^=]", stripped)
+
+
+def get_indentation(text):
+    return len(text) - len(text.lstrip())
+
+
+def random_edit(r, lines):
+    """Get (line, removed, new lines) that replaces up to three statements,
+    which have the same indentation, with up to three statements.
+    """
+    candidates = [i for i, text in enumerate(lines) if is_statement(text)]
+    line = r.choice(candidates)
+    indentation = get_indentation(lines[line])
+    removed, max_removed = 1, r.randint(1, 3)
+    while (
+        removed < max_removed
+        and line + removed < len(lines)
+        and is_statement(lines[line + removed])
+        and get_indentation(lines[line + removed]) == indentation
+    ):
+        removed += 1
+    # Don't run out of statements to replace
+    count = r.randint(0 if len(candidates) > 10 else 1, 3)
+    new_lines = [" " * indentation + r.choice(STATEMENTS) for _ in range(count)]
+    return line, removed, new_lines
+
+
+def flatten(scopes):
+    return [
+        (
+            scope.kind,
+            scope.name,
+            base,
+            scope.length,
+            depth,
+            sorted(
+                (name, base + line, column, kind)
+                for name, line, column, kind in scope.definitions
+            ),
+        )
+        for scope, base, depth in scopes.iter_scopes()
+    ]
+
+
+def get_paths(scopes, line_count):
+    return [
+        [(scope.kind, scope.name, base) for scope, base in scopes.scopes_at(line)]
+        for line in range(line_count)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_apply_edit_matches_rebuild(seed):
+    r = random.Random(seed)
+    lines = make_source(r.randint(20, 200), seed).split("\n")
+    scopes = build(lines)
+    for step in range(60):
+        line, removed, new_lines = random_edit(r, lines)
+        lines[line : line + removed] = new_lines
+        scopes.apply_edit(line, removed, len(new_lines))
+        expected = build(lines)
+        # Lookups work with the pending shifts, walks from the root apply them
+        assert get_paths(scopes, len(lines)) == get_paths(expected, len(lines))
+        for i in r.sample(range(len(lines)), min(5, len(lines))):
+            assert list(scopes.names_at(i, "t")) == list(expected.names_at(i, "t"))
+        if r.random() < 0.3:
+            assert flatten(scopes) == flatten(expected)
+    assert flatten(scopes) == flatten(expected)